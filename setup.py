@@ -19,11 +19,17 @@ setuptools.setup(
         package_dir={'': 'src'},
         packages=setuptools.find_packages(where='src'),
         install_requires=requirements,
+        extras_require={
+            'async': ['websockets'],
+            'image': ['numpy', 'Pillow'],
+        },
         python_requires='>=3.11',
         entry_points={
             'console_scripts': [
+                'onsdriver-cache=onsdriver.cache:main',
                 'onsdriver-firsttime=onsdriver.firsttime:main',
                 'onsdriver-obsinstall=onsdriver.obsinstall:main',
+                'onsdriver-obsmatrix=onsdriver.obsmatrix:main',
                 'onsdriver-obsplugin=onsdriver.obsplugin:main',
             ],
         },
@@ -0,0 +1,282 @@
+'''
+Download cache shared by processes
+'''
+
+import atexit
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import stat
+import sys
+import threading
+from onsdriver import util
+
+_DEFAULT_CACHE_DIR = '.onsdriver-cache'
+
+# Names in the cache directory that are not entries.
+LOCKS_DIR = '.locks'
+LINKS_DIR = '.links'
+API_DIR = 'api'
+EXTRACT_DIR = 'extracted'
+STATS_FILE = '.onsdriver-stats.json'
+
+# Written at last into an extracted tree in EXTRACT_DIR.
+EXTRACT_MANIFEST = '.onsdriver-extract.json'
+
+def get_cache_dir():
+    'Return the directory of the download cache'
+    return os.environ.get('ONSDRIVER_CACHE_DIR', _DEFAULT_CACHE_DIR)
+
+def prepare_cache_dir():
+    'Create the directory of the download cache'
+    path = get_cache_dir()
+    os.makedirs(path, exist_ok=True)
+    util.ignore_directory(path)
+    return path
+
+if sys.platform == 'win32':
+    import msvcrt # pylint: disable=import-error
+
+    def _lock(fd):
+        # LK_LOCK retries only for 10 seconds, keep trying until locked.
+        while True:
+            try:
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+
+    def _unlock(fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+else:
+    import fcntl # pylint: disable=import-error
+
+    def _lock(fd):
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+    def _unlock(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+class FileLock:
+    '''Exclusive lock between processes by a lock file
+
+    The lock is also exclusive between threads of a process.
+    '''
+    _thread_locks = {}
+    _thread_locks_lock = threading.Lock()
+
+    def __init__(self, path):
+        '''
+        :param path:  Path to the lock file, created if not existing.
+        '''
+        self.path = path
+        self._fd = None
+        with FileLock._thread_locks_lock:
+            self._thread_lock = FileLock._thread_locks.setdefault(
+                    os.path.abspath(path), threading.Lock())
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self):
+        'Wait until the lock is acquired'
+        self._thread_lock.acquire() # pylint: disable=consider-using-with
+        try:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            _lock(self._fd)
+        except BaseException:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._thread_lock.release()
+            raise
+
+    def release(self):
+        'Release the lock'
+        if self._fd is None:
+            return
+        try:
+            _unlock(self._fd)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+            self._thread_lock.release()
+
+def entry_lock(path):
+    '''Return a lock of a cache entry
+    The lock file is kept outside of the entry so that the entry can be removed while locked.
+    :param path:  Path to a file in the cache directory.
+    '''
+    cache_dir = prepare_cache_dir()
+    rel = os.path.relpath(path, cache_dir)
+    parts = rel.replace(os.sep, '/').split('/')
+    entry = parts[0]
+    if entry == EXTRACT_DIR and len(parts) > 1:
+        entry = f'{EXTRACT_DIR}-{parts[1]}'
+    os.makedirs(f'{cache_dir}/{LOCKS_DIR}', exist_ok=True)
+    return FileLock(f'{cache_dir}/{LOCKS_DIR}/{entry}.lock')
+
+def make_read_only(path):
+    'Remove the write permission from the files and the directories in the tree'
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        for name in dirnames + filenames:
+            p = f'{dirpath}/{name}'
+            if not os.path.islink(p):
+                os.chmod(p, stat.S_IMODE(os.lstat(p).st_mode) & ~0o222)
+    os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) & ~0o222)
+
+def remove_tree(path):
+    'Remove a tree even if it has been made read-only'
+    if not os.path.isdir(path) or os.path.islink(path):
+        return
+    os.chmod(path, stat.S_IRWXU)
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + (filenames if sys.platform == 'win32' else []):
+            p = f'{dirpath}/{name}'
+            if not os.path.islink(p):
+                os.chmod(p, stat.S_IRWXU)
+    shutil.rmtree(path, ignore_errors=True)
+
+def touch(path):
+    'Record the access to the entry containing the file'
+    os.utime(os.path.dirname(path))
+
+def _extracted_root(path):
+    'Return the real path of the extracted tree containing the path, or None'
+    store = os.path.realpath(f'{get_cache_dir()}/{EXTRACT_DIR}')
+    try:
+        rel = os.path.relpath(os.path.realpath(path), store)
+    except ValueError:
+        # On a different drive.
+        return None
+    name = rel.split(os.sep)[0]
+    if name in (os.curdir, os.pardir):
+        return None
+    return f'{store}/{name}'
+
+def touch_tree(path):
+    'Record the access to the extracted tree containing the path, if any'
+    root = _extracted_root(path)
+    if root:
+        try:
+            os.utime(root)
+        except OSError:
+            # Owned by another user, or removed.
+            pass
+
+def register_link(link):
+    '''Record an installation that is a symbolic link to an extracted tree
+    The tree is not pruned while the link points to it.
+    '''
+    if not os.path.islink(link) or not _extracted_root(link):
+        return
+    link = os.path.abspath(link)
+    links_dir = f'{prepare_cache_dir()}/{LINKS_DIR}'
+    os.makedirs(links_dir, exist_ok=True)
+    path = f'{links_dir}/{hashlib.sha256(link.encode()).hexdigest()}'
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}'
+    with open(tmp, 'w', encoding='utf-8') as fw:
+        fw.write(link)
+    os.replace(tmp, path)
+
+def linked_trees():
+    '''Return the extracted trees linked by the registered installations
+    Registrations of links removed or pointing elsewhere are dropped.
+    :return:  Set of the real paths of the trees.
+    '''
+    links_dir = f'{get_cache_dir()}/{LINKS_DIR}'
+    try:
+        names = os.listdir(links_dir)
+    except FileNotFoundError:
+        return set()
+    trees = set()
+    for name in names:
+        if '.' in name:
+            continue
+        path = f'{links_dir}/{name}'
+        try:
+            with open(path, 'r', encoding='utf-8') as fr:
+                link = fr.read()
+        except FileNotFoundError:
+            continue
+        root = _extracted_root(link) if os.path.islink(link) else None
+        if root:
+            trees.add(root)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    return trees
+
+_COUNTERS = ('hits', 'misses', 'bytes_saved', 'bytes_downloaded')
+
+class CacheStats:
+    'Counters of the download cache'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._registered = False
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.bytes_downloaded = 0
+
+    def _count(self, **kwargs):
+        with self._lock:
+            for key, value in kwargs.items():
+                setattr(self, key, getattr(self, key) + value)
+            if not self._registered:
+                atexit.register(self.save)
+                self._registered = True
+
+    def hit(self, size):
+        'Count a file found in the cache'
+        self._count(hits=1, bytes_saved=size)
+
+    def miss(self, size):
+        'Count a file downloaded'
+        self._count(misses=1, bytes_downloaded=size)
+
+    def as_dict(self):
+        'Return the counters as a dictionary'
+        with self._lock:
+            return {key: getattr(self, key) for key in _COUNTERS}
+
+    def save(self):
+        'Add the counters to the total saved in the cache directory, and reset them'
+        counts = self.as_dict()
+        if not any(counts.values()):
+            return
+        path = prepare_cache_dir() + '/' + STATS_FILE
+        with FileLock(path + '.lock'):
+            total = load_stats()
+            for key, value in counts.items():
+                total[key] = total.get(key, 0) + value
+            with open(path + '.tmp', 'w', encoding='utf-8') as fw:
+                json.dump(total, fw)
+            os.replace(path + '.tmp', path)
+        self._count(**{key: -value for key, value in counts.items()})
+
+    def __str__(self):
+        return (f'{self.hits} hit(s), {self.misses} miss(es), '
+                f'{self.bytes_saved / 1e6:.1f} MB saved, '
+                f'{self.bytes_downloaded / 1e6:.1f} MB downloaded')
+
+def load_stats():
+    'Return the counters saved in the cache directory'
+    try:
+        with open(get_cache_dir() + '/' + STATS_FILE, 'r', encoding='utf-8') as fr:
+            return json.load(fr)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+STATS = CacheStats()
@@ -2,46 +2,122 @@
 Download asset from GitHub release page
 '''
 
+import bisect
 import hashlib
+import http.client
 import json
 import os
 import os.path
 import re
 import sys
-import urllib.request
+import threading
+import time
 import urllib.parse
 import urllib.error
+from concurrent.futures import ThreadPoolExecutor
 from packaging.specifiers import SpecifierSet
-from onsdriver import util
+from packaging.version import InvalidVersion, Version
+from onsdriver import cache, _cache, _lockfile
+from onsdriver._http import Session
 
-_DOWNLOAD_CACHE_DIR = '.onsdriver-cache'
+# Seconds to use the cached API response without revalidation.
+_API_CACHE_TTL_DEFAULT = 300
 
-def _gh_urlopen(url, params=None):
+_SESSION = Session()
+
+_CHUNK_SIZE = 1024 * 1024
+
+# Number of the attempts to resume an interrupted download.
+_DOWNLOAD_RETRIES = 5
+
+_RELEASES_PER_PAGE = 100
+
+# Number of the threads to fetch the pages of the releases to rebuild the index.
+_RELEASES_MAX_WORKERS = 4
+
+# Seconds to rebuild the release index from all pages.
+_RELEASE_INDEX_MAX_AGE = 24 * 3600
+
+def _api_base():
+    return os.environ.get('ONSDRIVER_GITHUB_API_URL', 'https://api.github.com').rstrip('/')
+
+def _is_offline():
+    return bool(os.environ.get('ONSDRIVER_OFFLINE'))
+
+def _gh_urlopen(url, params=None, headers=None):
     if params:
         url = url + '?' + urllib.parse.urlencode(params)
-    req = urllib.request.Request(url)
+    headers = dict(headers or {})
     if 'GITHUB_TOKEN' in os.environ:
         token = os.environ['GITHUB_TOKEN']
-        req.add_header('authorization', f'Bearer {token}')
-    return urllib.request.urlopen(req)
+        headers['authorization'] = f'Bearer {token}'
+    return _SESSION.get(url, headers=headers)
+
+def _api_cache_path(url):
+    return f'{_cache.get_cache_dir()}/api/{hashlib.sha256(url.encode()).hexdigest()}.json'
+
+def _load_api_cache(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as fr:
+            return json.load(fr)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+
+def _save_api_cache(path, entry):
+    _cache.prepare_cache_dir()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}'
+    with open(tmp, 'w', encoding='utf-8') as fw:
+        json.dump(entry, fw)
+    os.replace(tmp, path)
+
+def _gh_get_json(url, params=None):
+    '''Get a JSON response of GitHub API through the cache
+    The cached response is used without a request within the TTL, or revalidated by its ETag.
+    If `ONSDRIVER_OFFLINE` is set, only the cache is used.
+    '''
+    if params:
+        url = url + '?' + urllib.parse.urlencode(params)
+    path = _api_cache_path(url)
+    entry = _load_api_cache(path)
+    if _is_offline():
+        if not entry:
+            raise ValueError(f'Not cached in offline mode: {url}')
+        return entry['body']
+    ttl = float(os.environ.get('ONSDRIVER_GH_CACHE_TTL', _API_CACHE_TTL_DEFAULT))
+    if entry and time.time() - entry['time'] < ttl:
+        return entry['body']
+
+    headers = {'accept': 'application/vnd.github+json'}
+    if entry and entry.get('etag'):
+        headers['if-none-match'] = entry['etag']
+    with _gh_urlopen(url, headers=headers) as res:
+        if res.status == 304 and entry:
+            res.read()
+        else:
+            entry = {'url': url, 'etag': res.headers.get('etag'),
+                     'body': json.loads(res.read().decode())}
+    entry['time'] = time.time()
+    _save_api_cache(path, entry)
+    return entry['body']
 
 def _get_release_url(repo_name):
     m = re.match(
             r'https?://(github.com|api.github.com/repos)/([^/]+/[^/]+)/releases/(tags/[^/]+)/?$',
             repo_name)
     if m:
-        return f'https://api.github.com/repos/{m[2]}/releases/{m[3]}'
+        return f'{_api_base()}/repos/{m[2]}/releases/{m[3]}'
     m = re.match(
             r'https?://(github.com|api.github.com/repos)/([^/]+/[^/]+)(|/|/releases/?)$', repo_name)
     if m:
-        return f'https://api.github.com/repos/{m[2]}/releases/latest'
+        return f'{_api_base()}/repos/{m[2]}/releases/latest'
     raise ValueError(f'Cannot get GitHub.com API URL for {repo_name}')
 
 def _get_releases_url(repo_name):
     m = re.match(
             r'https?://(github.com|api.github.com/repos)/([^/]+/[^/]+)(|/|/releases/?)$', repo_name)
     if m:
-        return f'https://api.github.com/repos/{m[2]}/releases'
+        return f'{_api_base()}/repos/{m[2]}/releases'
     raise ValueError(f'Cannot get GitHub.com API URL for {repo_name}')
 
 def _select_asset_from_gh(repo_name, file_re, filter_cb=None, version_specs=None):
@@ -49,16 +125,14 @@ def _select_asset_from_gh(repo_name, file_re, filter_cb=None, version_specs=None
         file_re = re.compile(file_re)
 
     if version_specs:
-        release_url = _latest_release_with_version(repo_name, version_specs)
+        latest = _latest_release_with_version(repo_name, version_specs)
     else:
         release_url = _get_release_url(repo_name)
-
-    try:
-        with _gh_urlopen(release_url) as res:
-            latest = json.loads(res.read().decode())
-    except urllib.error.HTTPError as e:
-        # pylint: disable=raise-missing-from
-        raise ValueError(f'{e}: {release_url}')
+        try:
+            latest = _gh_get_json(release_url)
+        except urllib.error.HTTPError as e:
+            # pylint: disable=raise-missing-from
+            raise ValueError(f'{e}: {release_url}')
 
     aa = []
     for a in latest['assets']:
@@ -79,51 +153,126 @@ def _select_asset_from_gh(repo_name, file_re, filter_cb=None, version_specs=None
 
     return aa[-1], latest
 
+class _PartialDownload:
+    # pylint: disable=too-few-public-methods
+    '''Download to a temporary file, resuming by Range requests
+
+    The digest is computed while writing, so that the file is not read again.
+    '''
+    def __init__(self, url, path):
+        self.url = url
+        self.part = path + '.part'
+        self.hasher = None
+        self.offset = 0
+        self.transferred = 0
+
+    def _restart(self):
+        self.hasher = hashlib.sha256()
+        self.offset = 0
+        if os.path.exists(self.part):
+            os.remove(self.part)
+
+    def _sync(self):
+        'Hash the part left by the previous run'
+        size = os.path.getsize(self.part) if os.path.exists(self.part) else 0
+        if self.hasher and size == self.offset:
+            return
+        self.hasher = hashlib.sha256()
+        self.offset = 0
+        if size:
+            with open(self.part, 'rb') as fr:
+                while data := fr.read(_CHUNK_SIZE):
+                    self.hasher.update(data)
+                    self.offset += len(data)
+
+    def _attempt(self):
+        self._sync()
+        headers = {'range': f'bytes={self.offset}-'} if self.offset else None
+        try:
+            res = _gh_urlopen(self.url, headers=headers)
+        except urllib.error.HTTPError as e:
+            if e.code != 416: # Range Not Satisfiable
+                raise
+            self._restart()
+            res = _gh_urlopen(self.url)
+        with res:
+            if self.offset and res.status != 206:
+                self._restart()
+            with open(self.part, 'ab' if self.offset else 'wb') as fw:
+                while data := res.read(_CHUNK_SIZE):
+                    fw.write(data)
+                    self.hasher.update(data)
+                    self.offset += len(data)
+                    self.transferred += len(data)
+
+    def run(self, restart=False):
+        '''Download the rest of the file
+        :return:  Hex digest of SHA-256.
+        '''
+        if restart:
+            self._restart()
+        for i in range(_DOWNLOAD_RETRIES):
+            try:
+                self._attempt()
+                break
+            except urllib.error.HTTPError:
+                raise
+            except (OSError, http.client.HTTPException) as e:
+                if i + 1 == _DOWNLOAD_RETRIES:
+                    raise
+                sys.stderr.write(f'Info: Resuming download of {self.url} after {e}\n')
+        return self.hasher.hexdigest()
+
 def _download_gh_asset(asset, force_download=False):
     name = asset['name']
     url = asset['browser_download_url']
 
     if asset['digest'] and asset['digest'].startswith('sha256:'):
         content_digest = asset['digest'][7:]
-        path = f'{_DOWNLOAD_CACHE_DIR}/{content_digest}/{name}'
+        path = f'{_cache.get_cache_dir()}/{content_digest}/{name}'
     else:
+        # Named apart from the content digest so that `onsdriver-cache verify` skips it.
         content_digest = None
         url_digest = hashlib.sha256(url.encode()).hexdigest()
-        path = f'{_DOWNLOAD_CACHE_DIR}/{url_digest}/{name}'
-
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    util.ignore_directory(_DOWNLOAD_CACHE_DIR)
-
-    if not os.path.exists(path) or force_download:
-        with _gh_urlopen(url) as res:
-            with open(path, 'wb') as fw:
-                while True:
-                    data = res.read(8192)
-                    if not data:
-                        break
-                    fw.write(data)
-
-    if content_digest:
-        with open(path, 'rb') as fr:
-            digest = hashlib.file_digest(fr, 'sha256')
-        if content_digest == digest.hexdigest():
+        path = f'{_cache.get_cache_dir()}/url-{url_digest}/{name}'
+
+    # Only one process downloads the file, the others wait and find it in the cache.
+    with _cache.entry_lock(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A file is published by rename only after it is verified.
+        if os.path.exists(path) and not force_download and \
+                os.path.getsize(path) == asset['size']:
+            _cache.touch(path)
+            _cache.STATS.hit(asset['size'])
             return path
 
-        if not force_download:
-            return _download_gh_asset(asset, force_download=True)
-
-        actual = digest.hexdigest()
-        raise ValueError(f'{path}: Digest mismatch, expect {content_digest} got {actual}')
-
-    # No content_digest, check the size only.
-    cached_size = os.path.getsize(path)
-    if asset['size'] == cached_size:
-        return path
-
-    if not force_download:
-        return _download_gh_asset(asset, force_download=True)
-
-    raise ValueError(f'{path}: size mismatch, expect {asset["size"]} got {cached_size}')
+        if _is_offline():
+            raise ValueError(f'Not cached in offline mode: {url}')
+
+        download = _PartialDownload(url, path)
+        for restart in (force_download, True):
+            digest = download.run(restart=restart)
+            size = download.offset
+            if content_digest:
+                if digest == content_digest:
+                    break
+                error = f'Digest mismatch, expect {content_digest} got {digest}'
+            else:
+                if size == asset['size']:
+                    break
+                error = f'size mismatch, expect {asset["size"]} got {size}'
+            if restart:
+                os.remove(download.part)
+                raise ValueError(f'{path}: {error}')
+
+        os.replace(download.part, path)
+        _cache.touch(path)
+        _cache.STATS.miss(download.transferred)
+
+    max_size = cache.get_max_size()
+    if max_size is not None:
+        cache.prune(max_size, keep=(os.path.dirname(path), ))
+    return path
 
 def _list_releases(repo_name, include_prerelease=False):
     '''Get the list of releases
@@ -137,8 +286,7 @@ def _list_releases(repo_name, include_prerelease=False):
     while True:
         page += 1
         try:
-            with _gh_urlopen(releases_url, params={'per_page': 100, 'page': page}) as res:
-                releases = json.loads(res.read().decode())
+            releases = _gh_get_json(releases_url, params={'per_page': 100, 'page': page})
         except urllib.error.HTTPError as e:
             if e.code==422: # Unprocessable Entity
                 return
@@ -152,24 +300,235 @@ def _list_releases(repo_name, include_prerelease=False):
 
         yield from releases
 
+def _version_bounds(version_specs, versions):
+    '''Return the range of the sorted versions that can satisfy the specifiers
+    The range is only narrowed, the versions in it have to be checked by the specifiers.
+    '''
+    lo, hi = 0, len(versions)
+    for spec in version_specs:
+        op, v = spec.operator, spec.version
+        if v.endswith('.*'):
+            if op == '==':
+                release = Version(v[:-2]).release
+                upper = Version('.'.join(str(x) for x in release[:-1] + (release[-1] + 1, )))
+                hi = min(hi, bisect.bisect_left(versions, upper))
+            continue
+        if op == '===':
+            continue
+        v = Version(v)
+        if op == '<':
+            hi = min(hi, bisect.bisect_left(versions, v))
+        elif op in ('<=', '=='):
+            hi = min(hi, bisect.bisect_right(versions, v))
+        elif op == '~=':
+            release = v.release[:-1]
+            upper = Version('.'.join(str(x) for x in release[:-1] + (release[-1] + 1, )))
+            hi = min(hi, bisect.bisect_left(versions, upper))
+        if op in ('>', '>=', '==', '~='):
+            lo = max(lo, bisect.bisect_left(versions, v))
+    return lo, hi
+
+class _ReleaseIndex:
+    '''Releases of a repository sorted by the version
+
+    The index is saved in the cache directory. It is refreshed by fetching the pages
+    until a known release appears, and the fetched releases replace the known ones.
+    All pages are fetched concurrently to rebuild the index on a cold start and once a day,
+    so that deleted releases and older releases changed from prerelease are reflected.
+    '''
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, repo_name):
+        self.url = _get_releases_url(repo_name)
+        self.path = _api_cache_path(self.url + '#index')
+        self.releases = []
+        self.versions = []
+        self.ids = set()
+        self.etag = None
+        self.time = 0
+        self.rebuilt = 0
+        entry = _load_api_cache(self.path)
+        if entry:
+            self._add(entry['releases'])
+            self.ids = set(entry['ids'])
+            self.etag = entry.get('etag')
+            self.time = entry['time']
+            self.rebuilt = entry.get('rebuilt', 0)
+
+    def _discard(self, ids):
+        if not ids & self.ids:
+            return
+        kept = [(v, r) for v, r in zip(self.versions, self.releases) if r['id'] not in ids]
+        self.versions = [v for v, _ in kept]
+        self.releases = [r for _, r in kept]
+        self.ids -= ids
+
+    def _add(self, releases):
+        'Add releases, replacing the known releases of the same ids'
+        releases = list(releases)
+        self._discard({rel['id'] for rel in releases})
+        for rel in releases:
+            self.ids.add(rel['id'])
+            try:
+                version = Version(rel['tag_name'])
+            except InvalidVersion:
+                continue
+            i = bisect.bisect_right(self.versions, version)
+            self.versions.insert(i, version)
+            self.releases.insert(i, {key: rel[key]
+                                     for key in ('id', 'tag_name', 'url', 'prerelease')})
+
+    def _save(self):
+        _save_api_cache(self.path, {
+            'url': self.url,
+            'etag': self.etag,
+            'time': self.time,
+            'rebuilt': self.rebuilt,
+            'ids': sorted(self.ids),
+            'releases': self.releases,
+        })
+
+    def _fetch_page(self, page, etag=None):
+        '''Fetch a page of the releases
+        :return:  Tuple of the list of the releases, the number of the last page if known,
+                  and the ETag. The list is None if not modified.
+        '''
+        params = {'per_page': _RELEASES_PER_PAGE, 'page': page}
+        headers = {'accept': 'application/vnd.github+json'}
+        if etag:
+            headers['if-none-match'] = etag
+        try:
+            with _gh_urlopen(self.url, params=params, headers=headers) as res:
+                body = res.read()
+                if res.status == 304:
+                    return None, None, etag
+                m = re.search(r'[?&]page=(\d+)[^>]*>;\s*rel="last"', res.headers.get('link') or '')
+                return json.loads(body.decode()), int(m[1]) if m else None, res.headers.get('etag')
+        except urllib.error.HTTPError as e:
+            if e.code==422: # Unprocessable Entity
+                return [], None, None
+            raise ValueError(f'{e}: {self.url}') from e
+
+    def update(self, release):
+        'Replace a known release by the release information fetched from its URL'
+        self._add([release])
+        self._save()
+
+    def remove(self, release_id):
+        'Remove a deleted release'
+        self._discard({release_id})
+        self._save()
+
+    def refresh(self):
+        '''Add the releases published after the last refresh
+        Nothing is fetched within the TTL of the API cache, or if `ONSDRIVER_OFFLINE` is set.
+        '''
+        if _is_offline():
+            if not self.time:
+                raise ValueError(f'Not cached in offline mode: {self.url}')
+            return
+        now = time.time()
+        ttl = float(os.environ.get('ONSDRIVER_GH_CACHE_TTL', _API_CACHE_TTL_DEFAULT))
+        if now - self.time < ttl:
+            return
+
+        rebuild = now - self.rebuilt >= _RELEASE_INDEX_MAX_AGE
+        releases, last, etag = self._fetch_page(1, etag=None if rebuild else self.etag)
+        if releases is None:
+            releases = []
+        elif rebuild:
+            if last:
+                with ThreadPoolExecutor(max_workers=_RELEASES_MAX_WORKERS) as executor:
+                    for rr, _, _ in executor.map(self._fetch_page, range(2, last + 1)):
+                        releases += rr
+            self.releases, self.versions, self.ids = [], [], set()
+            self.rebuilt = now
+        else:
+            page = 1
+            rr = releases
+            while len(rr) == _RELEASES_PER_PAGE and not any(r['id'] in self.ids for r in rr):
+                page += 1
+                rr, _, _ = self._fetch_page(page)
+                releases += rr
+        self._add(releases)
+        self.etag = etag
+        self.time = now
+        self._save()
+
+    def find(self, version_specs):
+        '''Return the release of the highest version satisfying the specifiers, or None
+        Prereleases are excluded.
+        '''
+        lo, hi = _version_bounds(version_specs, self.versions)
+        for i in range(hi - 1, lo - 1, -1):
+            rel = self.releases[i]
+            if not rel['prerelease'] and version_specs.contains(self.versions[i]):
+                return rel
+        return None
+
 def _latest_release_with_version(repo_name, version_specs):
     if isinstance(version_specs, str):
         version_specs = SpecifierSet(version_specs)
-    for rel in _list_releases(repo_name):
-        if version_specs.contains(rel['tag_name']):
-            return rel['url']
-    raise ValueError(f'No tags matching {version_specs} in {repo_name}')
+    index = _ReleaseIndex(repo_name)
+    index.refresh()
+    while True:
+        rel = index.find(version_specs)
+        if not rel:
+            raise ValueError(f'No tags matching {version_specs} in {repo_name}')
+        try:
+            release = _gh_get_json(rel['url'])
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                raise ValueError(f'{e}: {rel["url"]}') from e
+            # Deleted after the index was refreshed.
+            index.remove(rel['id'])
+            continue
+        if not release['prerelease']:
+            return release
+        index.update(release)
+
+def _lock_entry(asset, release):
+    entry = {
+            'name': asset['name'],
+            'url': asset['browser_download_url'],
+            'tag_name': release['tag_name'],
+            'size': asset['size'],
+    }
+    if asset['digest'] and asset['digest'].startswith('sha256:'):
+        entry['digest'] = asset['digest'][7:]
+    return entry
+
+def _get_pinned(lockfile, repo_name, file_re, version_specs):
+    entry = _lockfile.get(lockfile, repo_name)
+    if not entry or not re.match(file_re, entry['name']):
+        return None
+    if version_specs:
+        if isinstance(version_specs, str):
+            version_specs = SpecifierSet(version_specs)
+        if not version_specs.contains(entry['tag_name']):
+            return None
+    return entry
 
 def download_asset_with_file_re(
-        repo_name, file_re, filter_cb=None, info_only=False, version_specs=None):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        repo_name, file_re, filter_cb=None, info_only=False, version_specs=None, lockfile=None):
     '''Download an asset from GitHub release page
     :param repo_name:  Repository URL like "https://github.com/owner/repo" or a release URL
     :param file_re:    regex to select file to be downloaded
     :param filter_cb:  Callback function to filter assets
     :param version_specs:  Optional condition for version selection
+    :param lockfile:   Optional path to the lockfile. The asset pinned in the lockfile is
+                       downloaded without GitHub API. Otherwise, or if `info_only` is set,
+                       the resolved asset is pinned.
     '''
+    if lockfile and not info_only:
+        entry = _get_pinned(lockfile, repo_name, file_re, version_specs)
+        if entry:
+            return _download_gh_asset(_lockfile.to_asset(entry))
+
     asset, release = _select_asset_from_gh(
             repo_name, file_re, filter_cb=filter_cb, version_specs=version_specs)
+    if lockfile:
+        _lockfile.update(lockfile, repo_name, _lock_entry(asset, release))
     if info_only:
         ret = {
                 'name': asset['name'],
@@ -0,0 +1,157 @@
+'''
+HTTP client keeping the connections alive
+'''
+
+import base64
+import http.client
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+_MAX_REDIRECTS = 5
+
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# Errors of a kept-alive connection closed by the server, the request is sent again once.
+_STALE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+class Response:
+    '''Response of `Session.get`
+
+    The connection is returned to the session when the body has been read to the end.
+    '''
+    def __init__(self, url, resp, conn):
+        self.url = url
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.headers
+        self._resp = resp
+        self._conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, amt=None):
+        'Read the body'
+        return self._resp.read(amt)
+
+    def close(self):
+        'Close the response, the connection is closed too unless the body has been read'
+        if not self._resp.isclosed():
+            self._resp.close()
+            self._conn.close()
+
+def _get_proxy(scheme, netloc):
+    '''Return the proxy for the URL as a split URL, or None
+    Proxies are taken from the environment variables such as `https_proxy` and `no_proxy`
+    in the same way as `urllib.request.urlopen`.
+    '''
+    proxy = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(netloc):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    return urllib.parse.urlsplit(proxy)
+
+def _proxy_headers(proxy):
+    if not proxy.username:
+        return {}
+    user = urllib.parse.unquote(proxy.username)
+    password = urllib.parse.unquote(proxy.password or '')
+    token = base64.b64encode(f'{user}:{password}'.encode()).decode('ascii')
+    return {'Proxy-Authorization': f'Basic {token}'}
+
+class Session:
+    '''Keep a connection for each host and each thread
+
+    Redirections are followed. `Authorization` header is not sent to another host.
+    Proxies set by the environment variables are used, HTTPS is tunneled by CONNECT.
+    '''
+    def __init__(self, timeout=60):
+        '''
+        :param timeout:  Timeout of the socket in second.
+        '''
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _new_connection(self, scheme, netloc):
+        '''Create a connection
+        :return:  Tuple of the connection, and the headers to be added to each request
+                  if the requests are sent to a proxy with the absolute URL, otherwise None.
+        '''
+        if scheme not in ('http', 'https'):
+            raise ValueError(f'Unsupported scheme {scheme}')
+        proxy = _get_proxy(scheme, netloc)
+        if not proxy:
+            if scheme == 'https':
+                return http.client.HTTPSConnection(netloc, timeout=self.timeout), None
+            return http.client.HTTPConnection(netloc, timeout=self.timeout), None
+        proxy_port = proxy.port or 80
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(proxy.hostname, proxy_port, timeout=self.timeout)
+            conn.set_tunnel(netloc, headers=_proxy_headers(proxy))
+            return conn, None
+        conn = http.client.HTTPConnection(proxy.hostname, proxy_port, timeout=self.timeout)
+        return conn, _proxy_headers(proxy)
+
+    def _connection(self, scheme, netloc):
+        conns = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = {}
+        key = (scheme, netloc)
+        if key not in conns:
+            conns[key] = self._new_connection(scheme, netloc)
+        return conns[key]
+
+    def _request(self, url, headers):
+        u = urllib.parse.urlsplit(url)
+        target = urllib.parse.urlunsplit(('', '', u.path or '/', u.query, ''))
+        conn, proxy_headers = self._connection(u.scheme, u.netloc)
+        if proxy_headers is not None:
+            target = urllib.parse.urlunsplit((u.scheme, u.netloc, u.path or '/', u.query, ''))
+            headers = headers | proxy_headers
+        for retry in (True, False):
+            try:
+                conn.request('GET', target, headers=headers)
+                return conn, conn.getresponse()
+            except _STALE_ERRORS:
+                conn.close()
+                if not retry:
+                    raise
+        return None
+
+    def get(self, url, headers=None):
+        '''Send a GET request
+        :param url:      URL.
+        :param headers:  Dictionary of the request headers.
+        :return:         Response instance.
+        :raises urllib.error.HTTPError:  The status is 400 or above.
+        '''
+        headers = dict(headers or {})
+        host = urllib.parse.urlsplit(url).netloc
+        for _ in range(_MAX_REDIRECTS + 1):
+            conn, resp = self._request(url, headers)
+            res = Response(url, resp, conn)
+            if resp.status in _REDIRECT_CODES and resp.getheader('location'):
+                res.read()
+                res.close()
+                url = urllib.parse.urljoin(url, resp.getheader('location'))
+                if urllib.parse.urlsplit(url).netloc != host:
+                    headers = {k: v for k, v in headers.items() if k.lower() != 'authorization'}
+                continue
+            if resp.status >= 400:
+                res.read()
+                res.close()
+                raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+            return res
+        raise urllib.error.HTTPError(url, resp.status, 'Too many redirections', resp.headers, None)
+
+    def close(self):
+        'Close the connections of the current thread'
+        for conn, _ in getattr(self._local, 'conns', {}).values():
+            conn.close()
+        self._local.conns = {}
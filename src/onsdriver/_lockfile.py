@@ -0,0 +1,53 @@
+'''
+Pin the assets resolved from GitHub releases
+'''
+
+import json
+import os
+import threading
+
+_VERSION = 1
+
+_LOCK = threading.Lock()
+
+def _load(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as fr:
+            data = json.load(fr)
+    except FileNotFoundError:
+        return {'version': _VERSION, 'assets': {}}
+    if data.get('version') != _VERSION:
+        raise ValueError(f'{path}: Unsupported lockfile version {data.get("version")}')
+    return data
+
+def get(path, key):
+    '''Return a pinned entry
+    :param path:  Path to the lockfile.
+    :param key:   Repository URL.
+    :return:      Dictionary with 'name', 'url', 'tag_name', 'size' and optionally 'digest',
+                  or None if not pinned.
+    '''
+    with _LOCK:
+        return _load(path)['assets'].get(key)
+
+def update(path, key, entry):
+    '''Pin an entry
+    The other entries in the file are kept, so that the threads can share the lockfile.
+    '''
+    with _LOCK:
+        data = _load(path)
+        data['assets'][key] = entry
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fw:
+            json.dump(data, fw, indent=2, sort_keys=True)
+            fw.write('\n')
+        os.replace(tmp, path)
+
+def to_asset(entry):
+    'Convert a pinned entry to the asset information of GitHub API'
+    return {
+            'name': entry['name'],
+            'browser_download_url': entry['url'],
+            'digest': 'sha256:' + entry['digest'] if entry.get('digest') else None,
+            'size': entry['size'],
+    }
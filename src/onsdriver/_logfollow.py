@@ -0,0 +1,175 @@
+'''
+Follow the log file of OBS Studio without reading it again from the beginning
+'''
+
+import ctypes
+import ctypes.util
+import os
+import os.path
+import sys
+from onsdriver import util
+
+_IN_MODIFY = 0x00000002
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_CLOEXEC = 0o2000000
+_IN_NONBLOCK = 0o0004000
+
+class _Inotify:
+    'Minimal inotify binding through libc'
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.fd = fd
+
+    def add_watch(self, path, mask):
+        'Watch the path'
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+
+    def drain(self):
+        'Discard pending events'
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        'Close the inotify instance'
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+def _open_inotify():
+    if sys.platform != 'linux':
+        return None
+    try:
+        return _Inotify()
+    except (OSError, AttributeError, TypeError):
+        return None
+
+class LogFollower:
+    # pylint: disable=too-many-instance-attributes
+    '''Read lines appended to the latest log file in a directory
+
+    The file offset is kept between reads so that each line is read only once.
+    On Linux, the follower wakes up on inotify and on the process exit; otherwise, it polls.
+    '''
+    def __init__(self, logsdir, proc=None, poll_interval=0.1, on_open=None):
+        '''
+        :param logsdir:        Directory that OBS Studio writes log files into.
+        :param proc:           Optional Popen instance to detect the process exit.
+        :param poll_interval:  Interval to check the file and the process if not notified.
+        :param on_open:        Optional callable to be called with the path of a new log file.
+        '''
+        self.logsdir = logsdir
+        self.proc = proc
+        self.poll_interval = poll_interval
+        self.on_open = on_open
+        self.path = None
+        self._fr = None
+        self._partial = ''
+        self._inotify = _open_inotify()
+        self._watch_parent = False
+        self._watch_logsdir = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        'Release the file and the notifiers'
+        if self._fr:
+            self._fr.close()
+            self._fr = None
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+
+    def _latest(self):
+        try:
+            logs = [f for f in os.listdir(self.logsdir) if f.endswith('.txt')]
+        except FileNotFoundError:
+            return None
+        if not logs:
+            return None
+        return self.logsdir + '/' + max(logs)
+
+    def read_lines(self):
+        'Return complete lines appended since the last call'
+        latest = self._latest()
+        if latest and latest != self.path:
+            if self._fr:
+                self._fr.close()
+            self._fr = open(latest, 'r', encoding='utf-8', errors='replace') # pylint: disable=consider-using-with
+            self.path = latest
+            self._partial = ''
+            if self.on_open:
+                self.on_open(latest)
+        if not self._fr:
+            return []
+        lines = (self._partial + self._fr.read()).split('\n')
+        self._partial = lines.pop()
+        return lines
+
+    def _arm(self):
+        if not self._inotify or self._watch_logsdir:
+            return
+        try:
+            if not self._watch_parent:
+                self._inotify.add_watch(os.path.dirname(self.logsdir), _IN_CREATE | _IN_MOVED_TO)
+                self._watch_parent = True
+            self._inotify.add_watch(self.logsdir, _IN_CREATE | _IN_MODIFY | _IN_MOVED_TO)
+            self._watch_logsdir = True
+        except OSError as e:
+            if self._watch_parent and isinstance(e, FileNotFoundError):
+                # The logs directory is not created yet, the parent notifies its creation.
+                return
+            # Fall back to polling, such as if no more watches are available.
+            self._inotify.close()
+            self._inotify = None
+
+    def fileno(self):
+        'Return a file descriptor readable when the log may have changed, or None if not available'
+        self._arm()
+        return self._inotify.fd if self._inotify else None
+
+    def find(self, text):
+        '''Read the appended lines and return the first line containing the text
+        :return:  The line, or None if not found.
+        '''
+        self._arm()
+        if self._inotify:
+            self._inotify.drain()
+        for line in self.read_lines():
+            if text in line:
+                return line
+        return None
+
+    def wait_for(self, text, timeout, error_msg=None):
+        '''Wait for a line containing the text
+        :param text:       Text to find.
+        :param timeout:    Timeout in second.
+        :param error_msg:  Message for TimeoutError.
+        :return:           The line containing the text.
+        :raises ChildProcessError:  The process exited before the text appears.
+        '''
+        fds = []
+        cap = self.poll_interval
+        self._arm()
+        if self._inotify:
+            fds.append(self._inotify.fd)
+            cap = max(cap, 1.0)
+        return util.wait_until(
+                lambda: self.find(text), timeout,
+                backoff=util.Backoff(initial=self.poll_interval / 10, cap=cap),
+                fds=fds, procs=[self.proc] if self.proc else [],
+                error_msg=error_msg or f'Waiting "{text}" in log')
@@ -0,0 +1,88 @@
+'''
+Messages of obs-websocket protocol version 5
+'''
+
+import base64
+import hashlib
+import itertools
+import obsws_python
+
+OP_HELLO = 0
+OP_IDENTIFY = 1
+OP_IDENTIFIED = 2
+OP_EVENT = 5
+OP_REQUEST = 6
+OP_REQUEST_RESPONSE = 7
+OP_REQUEST_BATCH = 8
+OP_REQUEST_BATCH_RESPONSE = 9
+
+# RequestBatchExecutionType
+EXECUTION_SERIAL_REALTIME = 0
+EXECUTION_SERIAL_FRAME = 1
+EXECUTION_PARALLEL = 2
+
+_REQUEST_IDS = itertools.count(1)
+
+def new_request_id():
+    'Return a request ID unique in this process'
+    return f'onsdriver-{next(_REQUEST_IDS)}'
+
+def identify(hello, password=None, subs=0):
+    '''Return the Identify message for the Hello message
+    :param hello:     Decoded Hello message.
+    :param password:  Password of obs-websocket.
+    :param subs:      Event subscription flags.
+    '''
+    d = {'rpcVersion': 1, 'eventSubscriptions': int(subs)}
+    auth = hello['d'].get('authentication')
+    if auth:
+        if not password:
+            raise obsws_python.error.OBSSDKError('authentication enabled but no password provided')
+        secret = base64.b64encode(hashlib.sha256((password + auth['salt']).encode()).digest())
+        d['authentication'] = base64.b64encode(
+                hashlib.sha256(secret + auth['challenge'].encode()).digest()).decode()
+    return {'op': OP_IDENTIFY, 'd': d}
+
+def request(request_type, request_data=None, request_id=None):
+    '''Return a Request message
+    :return:  Tuple of the request ID and the message.
+    '''
+    if not request_id:
+        request_id = new_request_id()
+    d = {'requestType': request_type, 'requestId': request_id}
+    if request_data is not None:
+        d['requestData'] = request_data
+    return request_id, {'op': OP_REQUEST, 'd': d}
+
+def request_batch(requests, halt_on_failure=False, execution_type=EXECUTION_SERIAL_REALTIME):
+    '''Return a RequestBatch message
+    :param requests:  List of tuples of the request type and the request data.
+    :return:          Tuple of the request ID and the message.
+    '''
+    request_id = new_request_id()
+    reqs = []
+    for request_type, request_data in requests:
+        r = {'requestType': request_type}
+        if request_data is not None:
+            r['requestData'] = request_data
+        reqs.append(r)
+    return request_id, {
+            'op': OP_REQUEST_BATCH,
+            'd': {
+                'requestId': request_id,
+                'haltOnFailure': halt_on_failure,
+                'executionType': execution_type,
+                'requests': reqs,
+            },
+    }
+
+def response_data(d):
+    '''Return the response data of a RequestResponse or a result in RequestBatchResponse
+    :param d:  The 'd' field of RequestResponse, or an element of 'results'.
+    :raises obsws_python.error.OBSSDKRequestError:  The request failed.
+    '''
+    status = d['requestStatus']
+    if not status['result']:
+        raise obsws_python.error.OBSSDKRequestError(
+                d.get('requestType'), status['code'], status.get('comment'))
+    return d.get('responseData', {})
@@ -0,0 +1,195 @@
+'''
+Provision a directory from a read-only snapshot by links, and synchronize only changed files
+'''
+
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import stat
+import sys
+
+MANIFEST_NAME = '.onsdriver-manifest.json'
+
+# Files OBS Studio may rewrite in place. They are never hard-linked to the snapshot.
+_MUTABLE_EXTS = ('.ini', '.json', '.txt', '.bak', '.log', '.tmp')
+
+# Directories whose files may be rewritten in place by OBS Studio or plugins, such as the
+# SQLite databases of obs-browser.
+_MUTABLE_DIRS = ('logs/', 'plugin_config/')
+
+_FICLONE = 0x40049409
+
+def _reflink_linux(src, dst):
+    import fcntl # pylint: disable=import-outside-toplevel,import-error
+    with open(src, 'rb') as fr, open(dst, 'wb') as fw:
+        fcntl.ioctl(fw.fileno(), _FICLONE, fr.fileno())
+
+def _reflink_macos(src, dst):
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), dst)
+
+def _reflink(src, dst):
+    'Clone the file sharing the data blocks, return false if not supported'
+    try:
+        if sys.platform == 'linux':
+            _reflink_linux(src, dst)
+        elif sys.platform == 'darwin':
+            _reflink_macos(src, dst)
+        else:
+            return False
+    except (OSError, AttributeError):
+        if os.path.lexists(dst):
+            os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+def _file_digest(path):
+    with open(path, 'rb') as fr:
+        return hashlib.file_digest(fr, 'sha256').hexdigest()
+
+def _stat_key(st):
+    return [st.st_size, st.st_mtime_ns]
+
+def _is_mutable(rel):
+    return rel.startswith(_MUTABLE_DIRS) or rel.endswith(_MUTABLE_EXTS)
+
+def _list_tree(path):
+    '''List files and directories
+    :return:  Tuple of a dictionary from the relative path to the absolute path of files and
+              symlinks, and a set of relative paths of directories.
+    '''
+    files = {}
+    dirs = set()
+    for dirpath, dirnames, filenames in os.walk(path):
+        rel_dir = os.path.relpath(dirpath, path).replace(os.sep, '/')
+        prefix = '' if rel_dir == '.' else rel_dir + '/'
+        for name in dirnames:
+            if os.path.islink(dirpath + '/' + name):
+                files[prefix + name] = dirpath + '/' + name
+            else:
+                dirs.add(prefix + name)
+        for name in filenames:
+            if prefix or name != MANIFEST_NAME:
+                files[prefix + name] = dirpath + '/' + name
+    return files, dirs
+
+class SyncStats:
+    # pylint: disable=too-few-public-methods
+    'Numbers of the files handled by `sync_tree`'
+    def __init__(self):
+        self.linked = 0
+        self.reflinked = 0
+        self.copied = 0
+        self.kept = 0
+        self.removed = 0
+
+    def __str__(self):
+        return (f'linked {self.linked}, reflinked {self.reflinked}, copied {self.copied}, '
+                f'kept {self.kept}, removed {self.removed}')
+
+def _provision(src, dst, rel, stats, hardlink=True):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+        return None
+    if _reflink(src, dst):
+        stats.reflinked += 1
+    elif _is_mutable(rel) or not hardlink:
+        shutil.copy2(src, dst)
+        stats.copied += 1
+    else:
+        try:
+            os.link(src, dst)
+            stats.linked += 1
+        except OSError:
+            shutil.copy2(src, dst)
+            stats.copied += 1
+    if not hardlink:
+        # The snapshot may be read-only, the copy has to be writable.
+        os.chmod(dst, stat.S_IMODE(os.stat(dst).st_mode) | stat.S_IWUSR)
+    return _stat_key(os.stat(dst))
+
+def _load_manifest(dst_path):
+    try:
+        with open(dst_path + '/' + MANIFEST_NAME, 'r', encoding='utf-8') as fr:
+            return json.load(fr)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+def _unchanged(src, dst, entry):
+    '''Check the destination file still has the same content as the snapshot
+    :raises RuntimeError:  The snapshot was modified through a hard link.
+    '''
+    if os.path.islink(src) or os.path.islink(dst):
+        return os.path.islink(src) and os.path.islink(dst) and \
+                os.readlink(src) == os.readlink(dst)
+    if entry['src'] != _stat_key(os.stat(src)):
+        if entry.get('linked') and os.path.samefile(src, dst):
+            raise RuntimeError(f'{src} was modified through the hard link {dst}, '
+                               'restore the snapshot')
+        return False
+    if entry['dst'] == _stat_key(os.stat(dst)):
+        return True
+    if not entry.get('digest'):
+        entry['digest'] = _file_digest(src)
+    if _file_digest(dst) != entry['digest']:
+        return False
+    entry['dst'] = _stat_key(os.stat(dst))
+    return True
+
+def sync_tree(src_path, dst_path, hardlink=True):
+    '''Make the destination same as the snapshot
+    Files not modified since the last synchronization are kept.
+    :param src_path:  Path to the snapshot, which should not be modified.
+    :param dst_path:  Path to the destination.
+    :param hardlink:  Hardlink files that are not expected to be modified.
+                      If false, files are reflinked or copied, and made writable.
+    :return:          SyncStats instance.
+    :raises RuntimeError:  A hard-linked file was modified, which also modified the snapshot.
+    '''
+    # pylint: disable=too-many-locals
+    stats = SyncStats()
+    manifest = _load_manifest(dst_path)
+    src_files, src_dirs = _list_tree(src_path)
+    dst_files, dst_dirs = _list_tree(dst_path) if os.path.isdir(dst_path) else ({}, set())
+    new_manifest = {}
+
+    for rel, dst in dst_files.items():
+        entry = manifest.get(rel)
+        if rel in src_files and entry and _unchanged(src_files[rel], dst, entry):
+            new_manifest[rel] = entry
+            stats.kept += 1
+        else:
+            os.remove(dst)
+            stats.removed += 1
+
+    # Remove directories not in the snapshot such as logs, deepest first.
+    for rel in sorted(dst_dirs - src_dirs, reverse=True):
+        shutil.rmtree(dst_path + '/' + rel, ignore_errors=True)
+    for rel in src_dirs - dst_dirs:
+        os.makedirs(dst_path + '/' + rel, exist_ok=True)
+
+    for rel, src in src_files.items():
+        if rel in new_manifest:
+            continue
+        dst = dst_path + '/' + rel
+        dst_key = _provision(src, dst, rel, stats, hardlink=hardlink)
+        entry = {'src': _stat_key(os.lstat(src)), 'dst': dst_key}
+        if _is_mutable(rel) and dst_key:
+            entry['digest'] = _file_digest(src)
+        elif dst_key and os.path.samefile(src, dst):
+            entry['linked'] = True
+        new_manifest[rel] = entry
+
+    os.makedirs(dst_path, exist_ok=True)
+    with open(dst_path + '/' + MANIFEST_NAME, 'w', encoding='utf-8') as fw:
+        json.dump(new_manifest, fw)
+    return stats
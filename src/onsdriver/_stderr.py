@@ -0,0 +1,136 @@
+'''
+Read stderr of OBS Studio in background and classify each line
+'''
+
+import collections
+import queue
+import threading
+
+MAX_LINE_LENGTH = 65536
+
+class StderrMonitor:
+    '''Read a stream line by line in background
+
+    Only the recent lines and the error lines are kept, each in a bounded buffer,
+    so that the memory does not grow on a long run.
+    '''
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, stream, waived_re, context_lines=200, max_errors=1000, on_error=None):
+        '''
+        :param stream:         Binary stream to read, the stream is closed at the end.
+                               If None, lines are given by `feed` instead of a thread.
+        :param waived_re:      Compiled regular expression for error lines to be ignored.
+        :param context_lines:  Number of recent lines to keep.
+        :param max_errors:     Number of error lines to keep, also the size of `error_queue`.
+        :param on_error:       Optional callable to be called with each error line.
+                               It is called from the background thread. An exception raised by
+                               the callable does not stop reading the stream, the first one is
+                               raised by `raise_on_error` instead.
+        '''
+        self.waived_re = waived_re
+        self.context = collections.deque(maxlen=context_lines)
+        self.errors = collections.deque(maxlen=max_errors)
+        self.first_error = None
+        self.n_lines = 0
+        self.n_errors = 0
+        self.n_waived = 0
+        # Error lines not taken by `wait_error`, the lines are dropped and counted if it is full.
+        self.error_queue = queue.Queue(maxsize=max_errors)
+        self.n_queue_dropped = 0
+        self.callback_error = None
+        self._callbacks = [on_error] if on_error else []
+        self._stream = stream
+        self._lock = threading.Lock()
+        self._thread = None
+        if stream:
+            self._thread = threading.Thread(target=self._run, name='onsdriver-stderr', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                data = self._stream.readline(MAX_LINE_LENGTH)
+                if not data:
+                    break
+                self.feed(data)
+        finally:
+            self._stream.close()
+
+    def feed(self, line):
+        '''Classify a line
+        :param line:  String or bytes of a line.
+        '''
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        line = line.rstrip('\r\n')
+        with self._lock:
+            self.context.append(line)
+            self.n_lines += 1
+            if not line.startswith('error: '):
+                return
+            if self.waived_re.match(line):
+                self.n_waived += 1
+                return
+            self.errors.append(line)
+            self.n_errors += 1
+            if not self.first_error:
+                self.first_error = line
+            callbacks = list(self._callbacks)
+        try:
+            self.error_queue.put_nowait(line)
+        except queue.Full:
+            with self._lock:
+                self.n_queue_dropped += 1
+        for cb in callbacks:
+            try:
+                cb(line)
+            except Exception as e: # pylint: disable=broad-exception-caught
+                with self._lock:
+                    if not self.callback_error:
+                        self.callback_error = e
+
+    def add_callback(self, cb):
+        '''Add a callable to be called with each error line
+        :param cb:  Callable taking a line. It is called from the background thread.
+        '''
+        with self._lock:
+            self._callbacks.append(cb)
+
+    def get_context(self):
+        'Return a list of the recent lines'
+        with self._lock:
+            return list(self.context)
+
+    def get_errors(self):
+        'Return a list of the error lines that are not waived'
+        with self._lock:
+            return list(self.errors)
+
+    def wait_error(self, timeout=None):
+        '''Wait for the next error line
+        :param timeout:  Timeout in second, None to wait forever.
+        :return:         The error line, or None if timed out.
+        '''
+        try:
+            return self.error_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def raise_on_error(self):
+        '''Raise OSError if any error line has been found
+        If a callback has raised an exception, the exception is raised instead.
+        '''
+        if self.callback_error:
+            raise self.callback_error
+        if self.n_errors:
+            raise OSError(f'OBS has {self.n_errors} error(s) in log, first: {self.first_error}')
+
+    def join(self, timeout=None):
+        '''Wait until the stream reaches the end
+        :param timeout:  Timeout in second.
+        :return:         True if the stream has been read to the end.
+        '''
+        if not self._thread:
+            return True
+        self._thread.join(timeout=timeout)
+        return not self._thread.is_alive()
@@ -0,0 +1,101 @@
+'''
+Indexed tree of widgets or menus returned by ui-ws-automation
+'''
+
+import functools
+
+# Properties indexed to find the candidates of the last element of a path.
+_INDEX_KEYS = ('objectName', 'text', 'className')
+
+def _freeze_path(path):
+    'Convert the path to a hashable key, or return None if it has an unhashable value'
+    try:
+        key = tuple(tuple(sorted(cond.items())) for cond in path)
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+@functools.lru_cache(maxsize=256)
+def _compile_path(key):
+    '''Compile a frozen path
+    :return:  Tuple of the conditions of each element, and the index keys of the last element
+              with their values.
+    '''
+    index_keys = tuple((k, v) for k, v in key[-1] if k in _INDEX_KEYS and isinstance(v, str))
+    return key, index_keys
+
+def _match(node, cond):
+    for k, v in cond:
+        if k not in node or node[k] != v:
+            return False
+    return True
+
+class WidgetTree:
+    '''Widgets or menus with the indexes to find an object by a path
+
+    An object found by `find` is the same as `obsui._find_object` returns,
+    that is the first one in the pre-order.
+    '''
+    def __init__(self, root, children_key):
+        '''
+        :param root:          Response of 'widget-list' or 'menu-list'.
+        :param children_key:  Key of the children, 'children' or 'menu'.
+        '''
+        self.root = root
+        self._parent = {}
+        self._index = {}
+        self._by_depth = []
+        stack = [(child, root, 1) for child in reversed(root.get(children_key, []))]
+        while stack:
+            node, parent, depth = stack.pop()
+            self._parent[id(node)] = parent
+            if len(self._by_depth) < depth:
+                self._by_depth.append([])
+            self._by_depth[depth - 1].append(node)
+            for k in _INDEX_KEYS:
+                v = node.get(k)
+                if isinstance(v, str):
+                    self._index.setdefault((depth, k, v), []).append(node)
+            stack.extend((child, node, depth + 1) for child in reversed(node.get(children_key, [])))
+
+    def __len__(self):
+        return len(self._parent)
+
+    def parent(self, node):
+        'Return the parent of the node, or None for the top level'
+        parent = self._parent.get(id(node))
+        return None if parent is self.root else parent
+
+    def _candidates(self, index_keys, depth):
+        candidates = None
+        for k, v in index_keys:
+            nodes = self._index.get((depth, k, v), ())
+            if candidates is None or len(nodes) < len(candidates):
+                candidates = nodes
+        if candidates is None:
+            return self._by_depth[depth - 1] if depth <= len(self._by_depth) else ()
+        return candidates
+
+    def _ancestors_match(self, node, conds):
+        for cond in reversed(conds[:-1]):
+            node = self._parent[id(node)]
+            if not _match(node, cond):
+                return False
+        return True
+
+    def find(self, path):
+        '''Find an object
+        :param path:  List of dictionaries to match each level of the tree.
+        :return:      Dictionary of the object, or None if not found.
+        '''
+        if not path:
+            return None
+        key = _freeze_path(path)
+        if key is None:
+            raise TypeError(f'path has an unhashable value: {path}')
+        conds, index_keys = _compile_path(key)
+        for node in self._candidates(index_keys, len(conds)):
+            if _match(node, conds[-1]) and self._ancestors_match(node, conds):
+                return node
+        return None
@@ -0,0 +1,99 @@
+'''
+Read the screen of Xvfb from the memory-mapped XWD file written by `Xvfb -fbdir`
+'''
+
+import mmap
+import struct
+
+# Indices of the fields in XWDFileHeader, each is a big-endian CARD32.
+_HEADER_SIZE = 0
+_PIXMAP_WIDTH = 4
+_PIXMAP_HEIGHT = 5
+_BYTE_ORDER = 7
+_BITS_PER_PIXEL = 11
+_BYTES_PER_LINE = 12
+_RED_MASK = 14
+_GREEN_MASK = 15
+_BLUE_MASK = 16
+_NCOLORS = 19
+_N_FIELDS = 25
+
+_XWD_COLOR_SIZE = 12
+_LSB_FIRST = 0
+
+def _byte_offset(mask, lsb_first):
+    shift = (mask & -mask).bit_length() - 1
+    return shift // 8 if lsb_first else 3 - shift // 8
+
+def _channels(pixels, offsets):
+    'Select channels as a view if the offsets are contiguous'
+    first, last = offsets[0], offsets[-1]
+    step = 1 if last > first else -1
+    if list(offsets) == list(range(first, last + step, step)):
+        stop = last + step if last + step >= 0 else None
+        return pixels[..., first:stop:step]
+    return pixels[..., list(offsets)]
+
+class XWDFramebuffer:
+    '''Screen image of Xvfb backed by the memory-mapped file
+
+    Arrays returned by the methods are views of the screen and change as the screen is updated.
+    Call `copy()` of the array to keep an image.
+    '''
+    def __init__(self, path):
+        '''
+        :param path:  Path to the file such as `Xvfb_screen0` in the directory given by `-fbdir`.
+        '''
+        with open(path, 'rb') as fr:
+            self._mm = mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ)
+        header = struct.unpack_from(f'>{_N_FIELDS}I', self._mm, 0)
+        if header[_BITS_PER_PIXEL] != 32:
+            bpp = header[_BITS_PER_PIXEL]
+            self.close()
+            raise ValueError(f'{path}: {bpp} bits per pixel is not supported')
+        self.width = header[_PIXMAP_WIDTH]
+        self.height = header[_PIXMAP_HEIGHT]
+        self._bytes_per_line = header[_BYTES_PER_LINE]
+        self._offset = header[_HEADER_SIZE] + header[_NCOLORS] * _XWD_COLOR_SIZE
+        lsb_first = header[_BYTE_ORDER] == _LSB_FIRST
+        self._rgb_offsets = tuple(_byte_offset(header[i], lsb_first)
+                                  for i in (_RED_MASK, _GREEN_MASK, _BLUE_MASK))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        'Unmap the file, it is deferred until the arrays are released'
+        if self._mm:
+            try:
+                self._mm.close()
+            except BufferError:
+                pass
+            self._mm = None
+
+    def array(self):
+        '''Return the whole screen as it is stored
+        :return:  Read-only numpy array of the shape (height, width, 4).
+        '''
+        import numpy # pylint: disable=import-outside-toplevel,import-error
+        rows = numpy.frombuffer(self._mm, dtype=numpy.uint8,
+                                count=self._bytes_per_line * self.height, offset=self._offset)
+        rows = rows.reshape(self.height, self._bytes_per_line)
+        return rows[:, :self.width * 4].reshape(self.height, self.width, 4)
+
+    def rgb(self, x=0, y=0, width=None, height=None):
+        '''Return a region of the screen in RGB order
+        :param x:       Left of the region.
+        :param y:       Top of the region.
+        :param width:   Width of the region, default is to the right end.
+        :param height:  Height of the region, default is to the bottom end.
+        :return:        Read-only numpy array of the shape (height, width, 3).
+                        It is a view unless the pixel format needs reordering across bytes.
+        '''
+        x0, y0 = max(x, 0), max(y, 0)
+        x1 = self.width if width is None else min(x + width, self.width)
+        y1 = self.height if height is None else min(y + height, self.height)
+        return _channels(self.array()[y0:y1, x0:x1], self._rgb_offsets)
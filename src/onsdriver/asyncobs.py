@@ -0,0 +1,414 @@
+'''
+Start and control OBS Studio with asyncio
+
+This module requires the `websockets` package.
+'''
+
+import asyncio
+import base64
+import json
+import sys
+import obsws_python
+from onsdriver import obsconfig, obsexec, obsui, util
+from onsdriver import _obswsproto as proto
+from onsdriver._logfollow import LogFollower
+from onsdriver._stderr import MAX_LINE_LENGTH, StderrMonitor
+
+# This module shares the internals of obsexec and obsui.
+# pylint: disable=protected-access
+
+class AsyncOBSClient:
+    '''Asynchronous obs-websocket client
+
+    Requests are sent without waiting for the previous response,
+    and each response is delivered to the awaiting request by its ID.
+    '''
+    def __init__(self, ws):
+        self._ws = ws
+        self._pending = {}
+        self._reader = asyncio.ensure_future(self._read())
+
+    @classmethod
+    async def connect(cls, host='localhost', port=4455, password=None):
+        '''Connect and identify to obs-websocket
+        :return:  AsyncOBSClient instance.
+        '''
+        import websockets # pylint: disable=import-outside-toplevel,import-error
+        ws = await websockets.connect(f'ws://{host}:{port}', max_size=None)
+        try:
+            hello = json.loads(await ws.recv())
+            await ws.send(json.dumps(proto.identify(hello, password=password)))
+            identified = json.loads(await ws.recv())
+            if identified['op'] != proto.OP_IDENTIFIED:
+                raise ConnectionError('Failed to identify with obs-websocket')
+        except BaseException:
+            await ws.close()
+            raise
+        return cls(ws)
+
+    async def _read(self):
+        try:
+            async for msg in self._ws:
+                msg = json.loads(msg)
+                if msg['op'] not in (proto.OP_REQUEST_RESPONSE, proto.OP_REQUEST_BATCH_RESPONSE):
+                    continue
+                fut = self._pending.pop(msg['d']['requestId'], None)
+                if fut and not fut.done():
+                    fut.set_result(msg['d'])
+        finally:
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError('obs-websocket connection closed'))
+            self._pending.clear()
+
+    async def _send(self, request_id, msg):
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = fut
+        await self._ws.send(json.dumps(msg))
+        return await fut
+
+    async def send(self, request_type, request_data=None):
+        '''Send a request and return the response data
+        :raises obsws_python.error.OBSSDKRequestError:  The request failed.
+        '''
+        d = await self._send(*proto.request(request_type, request_data))
+        return proto.response_data(d)
+
+    async def send_batch(self, requests, halt_on_failure=False,
+                         execution_type=proto.EXECUTION_SERIAL_REALTIME):
+        '''Send requests in a RequestBatch message
+        :param requests:  List of tuples of the request type and the request data.
+        :return:          List of the results, each is the response data or an exception.
+        '''
+        d = await self._send(*proto.request_batch(
+            requests, halt_on_failure=halt_on_failure, execution_type=execution_type))
+        ret = []
+        for r in d['results']:
+            try:
+                ret.append(proto.response_data(r))
+            except Exception as e: # pylint: disable=broad-exception-caught
+                ret.append(e)
+        return ret
+
+    async def close(self):
+        'Close the connection'
+        await self._ws.close()
+        await asyncio.gather(self._reader, return_exceptions=True)
+
+class AsyncOBSUI:
+    'Communicate with ui-ws-automation plugin asynchronously'
+
+    def __init__(self, cl):
+        self.cl = cl
+
+    async def request(self, request_type, request_data, retry=3):
+        'Invoke a request on ui-ws-automation'
+        param = {
+                'vendorName': obsui._VENDOR_NAME,
+                'requestType': request_type,
+                'requestData': request_data,
+        }
+        intervals = iter(util.Backoff(initial=0.02, cap=obsui._POLL_CAP))
+        deadline = asyncio.get_running_loop().time() + retry * obsui._RETRY_WAIT
+        while True:
+            res = (await self.cl.send('CallVendorRequest', param))['responseData']
+            if 'error' not in res:
+                return res
+            error = res['error']
+            remaining = deadline - asyncio.get_running_loop().time()
+            if error != obsui._ERROR_NO_OBJECT or remaining <= 0:
+                raise OSError(error)
+            await asyncio.sleep(min(next(intervals), remaining))
+
+    async def menu_list(self, path=None):
+        'Return a list of menu actions'
+        res = await self.request('menu-list', {})
+        if not path:
+            return res
+        return obsui._find_object(res, 'menu', path)
+
+    async def widget_list(self, path=None):
+        'Return a list of widgets'
+        res = await self.request('widget-list', {})
+        if not path:
+            return res
+        return obsui._find_object(res, 'children', path)
+
+    async def wait_for_widget(self, path, timeout=5.0):
+        '''Wait until a widget exists
+        :param path:     List to describe the widget.
+        :param timeout:  Timeout in second.
+        :return:         Tuple of the widget and the seconds waited.
+        :raises TimeoutError:  The widget did not appear within the timeout.
+        '''
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        intervals = iter(util.Backoff(initial=0.02, cap=obsui._POLL_CAP))
+        while True:
+            widget = await self.widget_list(path)
+            if widget:
+                return widget, loop.time() - start
+            remaining = start + timeout - loop.time()
+            if remaining <= 0:
+                raise TimeoutError(f'Waiting widget {path}')
+            await asyncio.sleep(min(next(intervals), remaining))
+
+    async def grab(self, path, window=False, filename=None):
+        '''Request to get an image of a widget
+        :param path:      List to describe the widget.
+        :param window:    Boolean value to control grab type.
+        :param filename:  File name to save the PNG file to. If given, None is returned.
+        :return:          Bytes object representing PNG.
+        '''
+        s_type = 'window' if window else 'grab'
+        res = await self.request('widget-grab', {'path': path, 'type': s_type})
+        return obsui._save_png(base64.b64decode(res['image']), filename)
+
+class AsyncOBSExec:
+    # pylint: disable=too-many-instance-attributes
+    'Run OBS Studio with asyncio'
+
+    def __init__(self, config=None, exec_path=None, enable_obsws=True, on_error=None):
+        '''
+        :param config:        OBSConfig instance.
+        :param exec_path:     Path to the executable file.
+        :param enable_obsws:  Enable obs-websocket in the configuration.
+        :param on_error:      Optional callable to be called with each non-waived error line.
+        '''
+        if not config:
+            config = obsconfig.OBSConfig()
+        if exec_path:
+            self.exec_path = obsexec._normalize_exec_path(exec_path)
+        else:
+            self.exec_path = obsexec.get_exec_path()
+        self.config = config
+        self.proc_obs = None
+        self.stderr = None
+        self.timing = None
+        self.on_error = on_error
+        self._obsws = None
+        self._stderr_task = None
+        self._exit_task = None
+        if enable_obsws:
+            config.enable_obsws()
+
+    async def start(self, timeout=None):
+        '''Start OBS Studio and wait until the main window is visible
+        :param timeout:  Timeout for the startup log in second.
+        '''
+        self.timing = obsexec.StartupTiming(exec_path=self.exec_path)
+        # Starting Xvfb and removing the logs block, let the other instances start meanwhile.
+        cmd, proc_cwd, env = await asyncio.to_thread(self._prepare)
+        self.proc_obs = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout = asyncio.subprocess.DEVNULL,
+                stderr = asyncio.subprocess.PIPE,
+                cwd = proc_cwd,
+                env = env,
+                limit = MAX_LINE_LENGTH,
+        )
+        self.stderr = StderrMonitor(None, obsexec._WAIVED_ERRORS_RE,
+                                    on_error=self.on_error)
+        self._stderr_task = asyncio.ensure_future(self._read_stderr())
+        self._exit_task = asyncio.ensure_future(self.proc_obs.wait())
+        self.timing.mark('spawn')
+
+        if timeout is None:
+            timeout = 25 if sys.platform == 'win32' else 10
+        try:
+            await self._wait_log('Switched to scene', timeout)
+            self.timing.mark('scene_switched')
+            cfg = self.config.get_obsws_cfg()
+            if cfg.get('server_enabled'):
+                await self._wait_visible()
+                self.timing.mark('window_visible')
+        except Exception:
+            for line in self.stderr.get_context():
+                print(line)
+            raise
+
+    def _prepare(self):
+        self.config.remove_logs()
+        return obsexec._prepare_exec(self.exec_path, self.config, self.timing)
+
+    async def _read_stderr(self):
+        stream = self.proc_obs.stderr
+        while True:
+            try:
+                data = await stream.readline()
+            except ValueError:
+                # The line is too long, take it partially.
+                data = await stream.read(MAX_LINE_LENGTH)
+            if not data:
+                break
+            self.stderr.feed(data)
+
+    async def _wait_log(self, text, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        intervals = iter(util.Backoff(initial=0.01, cap=0.1))
+        with LogFollower(self.config.path + '/logs',
+                         on_open=lambda _: self.timing.mark('log_created')) as follower:
+            notified = asyncio.Event()
+            fd = follower.fileno()
+            if fd is not None:
+                loop.add_reader(fd, notified.set)
+            try:
+                while True:
+                    exited = self._exit_task.done()
+                    notified.clear()
+                    if follower.find(text):
+                        return
+                    if exited:
+                        code = self.proc_obs.returncode
+                        raise ChildProcessError(f'OBS process exit with code {code} during startup')
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        raise TimeoutError('Checking startup by log')
+                    wakeup = asyncio.ensure_future(notified.wait())
+                    await asyncio.wait([wakeup, self._exit_task],
+                                       timeout=min(next(intervals), remaining),
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    wakeup.cancel()
+            finally:
+                if fd is not None:
+                    loop.remove_reader(fd)
+
+    async def _wait_visible(self, timeout=10):
+        ui = AsyncOBSUI(await self.get_obsws())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        intervals = iter(util.Backoff(initial=0.02, cap=0.2))
+        while True:
+            try:
+                if (await ui.request('widget-list', {}))['visible']:
+                    return
+            except obsws_python.error.OBSSDKRequestError as e:
+                if e.code != 207: # OBS is not ready to perform the request.
+                    raise e
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise TimeoutError('Waiting main window is visible')
+            await asyncio.sleep(min(next(intervals), remaining))
+
+    async def get_obsws(self, timeout=5):
+        '''Return a connected AsyncOBSClient, shared by the callers
+        :param timeout:  Timeout to connect in second.
+        '''
+        if self._obsws:
+            return self._obsws
+        if not self.proc_obs:
+            raise RuntimeError('OBS is not started')
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        intervals = iter(util.Backoff(initial=0.02, cap=0.5))
+        while True:
+            try:
+                self._obsws = await AsyncOBSClient.connect(
+                        port=self.config.get_obsws_port(),
+                        password=obsexec._get_obsws_passwd(self.config))
+                self.timing.mark('obsws_connected')
+                return self._obsws
+            except OSError:
+                # ConnectionRefusedError, or OSError if all of the addresses failed.
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise
+                await asyncio.sleep(min(next(intervals), remaining))
+
+    async def get_ui(self):
+        'Return an AsyncOBSUI instance on the shared connection'
+        return AsyncOBSUI(await self.get_obsws())
+
+    async def close_ws(self):
+        'Close the websocket client to prepare shutdown'
+        if self._obsws:
+            await self._obsws.close()
+            self._obsws = None
+
+    async def shutdown(self, check_error=True):
+        'Shutdown OBS Studio and wait it to exit'
+        cl = await self.get_obsws()
+        res = await cl.send('CallVendorRequest', obsexec._shutdown_request())
+        if res['responseData'] != {}:
+            raise ValueError(f'shutdown request returned {res["responseData"]}')
+        await self.wait(check_error=check_error)
+
+    async def _kill(self):
+        await self.close_ws()
+        if not self.proc_obs:
+            return
+        if self.proc_obs.returncode is None:
+            self.proc_obs.kill()
+        await self._exit_task
+        try:
+            await asyncio.wait_for(self._stderr_task, timeout=5)
+        except asyncio.TimeoutError:
+            self._stderr_task.cancel()
+
+    async def wait(self, check_error=True):
+        'Wait OBS to exit'
+        await self.close_ws()
+        if not self.proc_obs:
+            return
+        exit_code = await self._exit_task
+        try:
+            await asyncio.wait_for(self._stderr_task, timeout=5)
+        except asyncio.TimeoutError:
+            sys.stderr.write('Warning: stderr of OBS is still open after exit.\n')
+        obsexec._check_exit(exit_code, self.stderr, check_error)
+
+def copy_configs(src_path, count):
+    '''Return isolated configurations copied from a saved configuration
+    :param src_path:  Path to the saved configuration.
+    :param count:     Number of the configurations.
+    '''
+    return [obsconfig.OBSConfigCopyFromSaved(src_path, isolated=True) for _ in range(count)]
+
+async def start_many(configs, **kwargs):
+    '''Start OBS Studio instances concurrently
+    If any of the instances fails to start, the others are shut down, the failed ones are killed,
+    and the configurations of all of them are cleaned up before the error is raised.
+    :param configs:  Iterable of isolated OBSConfig instances.
+    :param kwargs:   Passed to AsyncOBSExec.
+    :return:         List of AsyncOBSExec instances.
+    '''
+    instances = [AsyncOBSExec(config=cfg, **kwargs) for cfg in configs]
+    results = await asyncio.gather(*[obs.start() for obs in instances], return_exceptions=True)
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        started = [obs for obs, r in zip(instances, results) if not isinstance(r, BaseException)]
+        failed = [obs for obs, r in zip(instances, results) if isinstance(r, BaseException)]
+        await asyncio.gather(shutdown_many(started, check_error=False),
+                             *[obs._kill() for obs in failed], return_exceptions=True)
+        for obs in failed:
+            obs.config.cleanup()
+        raise errors[0]
+    return instances
+
+async def shutdown_many(instances, check_error=True):
+    '''Shutdown OBS Studio instances concurrently
+    :param instances:    Iterable of AsyncOBSExec instances.
+    :param check_error:  Raise OSError if any instance has an error.
+    '''
+    instances = list(instances)
+    results = await asyncio.gather(*[obs.shutdown(check_error=check_error) for obs in instances],
+                                   return_exceptions=True)
+    for obs in instances:
+        obs.config.cleanup()
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        raise errors[0]
+
+async def run_many(configs, func, **kwargs):
+    '''Start instances, call `func` for each instance concurrently, and shut them down
+    :param configs:  Iterable of isolated OBSConfig instances.
+    :param func:     Coroutine function taking an AsyncOBSExec instance.
+    :param kwargs:   Passed to AsyncOBSExec.
+    :return:         List of the results of `func`.
+    '''
+    instances = await start_many(configs, **kwargs)
+    try:
+        return await asyncio.gather(*[func(obs) for obs in instances])
+    finally:
+        await shutdown_many(instances)
@@ -0,0 +1,193 @@
+'''
+Inspect and prune the download cache
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import os.path
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from onsdriver import _cache
+
+_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+_SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+def parse_size(s):
+    '''Parse a size such as "500M" or "10G"
+    :return:  Number of bytes.
+    '''
+    m = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)i?B?\s*$', s, re.IGNORECASE)
+    if not m:
+        raise ValueError(f'Invalid size: {s}')
+    return int(float(m[1]) * _UNITS[m[2].upper()])
+
+def get_max_size():
+    'Return the size limit of the cache from `ONSDRIVER_CACHE_MAX_SIZE`, or None'
+    value = os.environ.get('ONSDRIVER_CACHE_MAX_SIZE')
+    return parse_size(value) if value else None
+
+def _extracted_package(path):
+    try:
+        with open(f'{path}/{_cache.EXTRACT_MANIFEST}', 'r', encoding='utf-8') as fr:
+            return json.load(fr)['package']
+    except (FileNotFoundError, json.decoder.JSONDecodeError, KeyError):
+        return '?'
+
+class CacheEntry:
+    # pylint: disable=too-few-public-methods
+    '''Directory in the cache holding a downloaded file or an extracted package
+    An extracted package is in use while an installation is a symbolic link to it.
+    '''
+    def __init__(self, path, in_use=False):
+        self.path = path
+        self.key = os.path.basename(path)
+        self.extracted = os.path.basename(os.path.dirname(path)) == _cache.EXTRACT_DIR
+        self.in_use = in_use
+        if self.extracted:
+            self.files = [f'(extracted {_extracted_package(path)})']
+        else:
+            self.files = sorted(name for name in os.listdir(path)
+                                if not name.startswith('.') and not name.endswith('.part'))
+        self.size = 0
+        for dirpath, _, filenames in os.walk(path):
+            self.size += sum(os.lstat(f'{dirpath}/{name}').st_size for name in filenames)
+        self.last_access = os.stat(path).st_mtime
+
+    def __str__(self):
+        t = time.strftime('%Y-%m-%d %H:%M', time.localtime(self.last_access))
+        in_use = ' (in use)' if self.in_use else ''
+        return f'{t} {self.size:>12} {self.key[:12]} {" ".join(self.files)}{in_use}'
+
+def _entry_paths(cache_dir):
+    for name in os.listdir(cache_dir):
+        path = f'{cache_dir}/{name}'
+        if name.startswith('.') or name == _cache.API_DIR or not os.path.isdir(path):
+            continue
+        if name != _cache.EXTRACT_DIR:
+            yield path
+            continue
+        for digest in os.listdir(path):
+            # Skip the trees being extracted.
+            if '.' not in digest:
+                yield f'{path}/{digest}'
+
+def list_entries():
+    '''Return the entries of the cache, including the extracted packages
+    :return:  List of CacheEntry instances, least recently used first.
+    '''
+    cache_dir = _cache.get_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return []
+    linked = _cache.linked_trees()
+    entries = []
+    for path in _entry_paths(cache_dir):
+        try:
+            entries.append(CacheEntry(path, in_use=os.path.realpath(path) in linked))
+        except FileNotFoundError:
+            # Removed by another process.
+            pass
+    return sorted(entries, key=lambda e: e.last_access)
+
+def _remove(entry):
+    with _cache.entry_lock(entry.path + '/'):
+        _cache.remove_tree(entry.path)
+
+def prune(max_size, keep=()):
+    '''Remove least recently used entries until the total size fits
+    Entries in use are never removed, so the total may stay above the limit.
+    :param max_size:  Size limit in bytes.
+    :param keep:      Paths of the entries not to be removed.
+    :return:          List of the removed entries.
+    '''
+    keep = {os.path.realpath(path) for path in keep}
+    entries = list_entries()
+    total = sum(e.size for e in entries)
+    removed = []
+    for entry in entries:
+        if total <= max_size:
+            break
+        if entry.in_use or os.path.realpath(entry.path) in keep:
+            continue
+        _remove(entry)
+        total -= entry.size
+        removed.append(entry)
+    return removed
+
+def _verify_entry(entry):
+    if entry.extracted or not _SHA256_RE.match(entry.key) or len(entry.files) != 1:
+        return None
+    with open(f'{entry.path}/{entry.files[0]}', 'rb') as fr:
+        digest = hashlib.file_digest(fr, 'sha256').hexdigest()
+    return digest == entry.key
+
+def verify(max_workers=None, remove=False):
+    '''Hash the entries named by their SHA-256 digest in parallel
+    :param max_workers:  Number of the threads.
+    :param remove:       Remove the entries not matching the digest.
+    :return:             List of tuples of the entry and the result,
+                         True if matched, False if not matched, None if the digest is unknown.
+    '''
+    entries = list_entries()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(zip(entries, executor.map(_verify_entry, entries)))
+    if remove:
+        for entry, ok in results:
+            if ok is False:
+                _remove(entry)
+    return results
+
+def _get_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help='List entries, least recently used first')
+    p = sub.add_parser('prune', help='Remove least recently used entries')
+    p.add_argument('--max-size', action='store', default=None,
+                   help='Size limit such as 10G, default is ONSDRIVER_CACHE_MAX_SIZE')
+    p = sub.add_parser('verify', help='Rehash entries')
+    p.add_argument('-j', '--jobs', action='store', type=int, default=None)
+    p.add_argument('--remove', action='store_true', default=False,
+                   help='Remove broken entries')
+    sub.add_parser('stats', help='Show hit statistics')
+    return parser.parse_args()
+
+def main():
+    'Entry point'
+    args = _get_args()
+    print(f'Cache directory: {_cache.get_cache_dir()}')
+
+    if args.command == 'list':
+        entries = list_entries()
+        for entry in entries:
+            print(entry)
+        print(f'{len(entries)} entries, {sum(e.size for e in entries)} bytes')
+
+    elif args.command == 'prune':
+        max_size = parse_size(args.max_size) if args.max_size else get_max_size()
+        if max_size is None:
+            sys.exit('Error: Specify --max-size or ONSDRIVER_CACHE_MAX_SIZE')
+        removed = prune(max_size)
+        for entry in removed:
+            print(f'Removed {entry}')
+        print(f'Removed {len(removed)} entries, {sum(e.size for e in removed)} bytes')
+
+    elif args.command == 'verify':
+        n_broken = 0
+        for entry, ok in verify(max_workers=args.jobs, remove=args.remove):
+            status = {True: 'ok', False: 'BROKEN', None: 'unknown'}[ok]
+            print(f'{status:7} {entry}')
+            n_broken += ok is False
+        if n_broken and not args.remove:
+            sys.exit(1)
+
+    elif args.command == 'stats':
+        stats = _cache.load_stats()
+        for key in ('hits', 'misses', 'bytes_saved', 'bytes_downloaded'):
+            print(f'{key}: {stats.get(key, 0)}')
+
+if __name__ == '__main__':
+    main()
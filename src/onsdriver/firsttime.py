@@ -6,36 +6,90 @@ import argparse
 import base64
 import os
 import shutil
-from onsdriver import obsconfig, obsplugin, obsexec, obsui, util
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from onsdriver import obsconfig, obsinstall, obsplugin, obsexec, util
+from onsdriver import _cache
 
 _REQUIRED_PLUGIN_URLS = (
         'https://github.com/noris-plugins-for-obs/ui-ws-automation',
         'https://github.com/noris-plugins-for-obs/shutdown-plugin',
 )
 
-def _download_plugins(additional_plugins, obs=None, info_only=False):
-    ret = []
+_MAX_DOWNLOAD_WORKERS = 4
 
+def _run_jobs(jobs, max_workers=_MAX_DOWNLOAD_WORKERS):
+    '''Run jobs concurrently and print the time of each
+    :param jobs:  List of tuples of the label and the callable.
+    :return:      List of the returned values in the order of `jobs`.
+    '''
+    def _timed(func):
+        t = time.monotonic()
+        ret = func()
+        return ret, time.monotonic() - t
+
+    t_start = time.monotonic()
+    results = [None] * len(jobs)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_timed, func): i for i, (_, func) in enumerate(jobs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i], elapsed = future.result()
+            sys.stderr.write(f'Info: {jobs[i][0]} done in {elapsed:.1f} s\n')
+    if len(jobs) > 1:
+        elapsed = time.monotonic() - t_start
+        sys.stderr.write(f'Info: {len(jobs)} downloads done in {elapsed:.1f} s\n')
+    sys.stderr.write(f'Info: Download cache: {_cache.STATS}\n')
+    return results
+
+def _plugin_jobs(additional_plugins, obs=None, info_only=False, lockfile=None):
+    jobs = []
     for plugin in _REQUIRED_PLUGIN_URLS:
-        ret.append(obsplugin.download_plugin(plugin, obs=obs, info_only=info_only))
+        jobs.append((plugin, lambda p=plugin: obsplugin.download_plugin(
+            p, obs=obs, info_only=info_only, lockfile=lockfile)))
 
     if additional_plugins:
         for plugin in additional_plugins:
             if plugin.startswith('http://') or plugin.startswith('https://'):
-                ret.append(obsplugin.download_plugin(plugin, info_only=info_only))
+                jobs.append((plugin, lambda p=plugin: obsplugin.download_plugin(
+                    p, info_only=info_only, lockfile=lockfile)))
             else:
-                ret.append(plugin)
+                jobs.append((plugin, lambda p=plugin: p))
+    return jobs
 
-    return ret
+def _install_obs_job(destination, obs=None, info_only=False, lockfile=None):
+    version_specs = f'=={obs}.*' if obs else None
+    return ('OBS Studio', lambda: obsinstall.install_obs(
+        destination=destination, info_only=info_only, version_specs=version_specs,
+        lockfile=lockfile))
+
+def _download_plugins(
+        additional_plugins, obs=None, info_only=False, install_obs=None, lockfile=None):
+    '''Download plugins concurrently
+    :param install_obs:  Destination to install OBS Studio at the same time.
+    :param lockfile:     Optional path to the lockfile to pin the releases.
+    :return:             List of the downloaded plugins, and the result of `install_obs`
+                         at the end if it is given.
+    '''
+    jobs = _plugin_jobs(additional_plugins, obs=obs, info_only=info_only, lockfile=lockfile)
+    if install_obs:
+        jobs.append(_install_obs_job(install_obs, obs=obs, info_only=info_only,
+                                     lockfile=lockfile))
+    return _run_jobs(jobs)
 
-def _prepare_config(obs, additional_plugins):
+def _prepare_config(obs, additional_plugins, install_obs=None, lockfile=None):
     cfg = obsconfig.OBSConfig()
     cfg.remove_files()
     cfg.get_global_cfg('General')['EnableAutoUpdates'] = 'false'
     cfg.get_global_cfg('General')['MacOSPermissionsDialogLastShown'] = '65535'
     cfg.save_global_cfg()
 
-    for path in _download_plugins(obs=obs, additional_plugins=additional_plugins):
+    paths = _download_plugins(obs=obs, additional_plugins=additional_plugins,
+                              install_obs=install_obs, lockfile=lockfile)
+    if install_obs:
+        paths = paths[:-1]
+    for path in paths:
         obsplugin.install_plugin(path)
 
     return cfg
@@ -43,7 +97,7 @@ def _prepare_config(obs, additional_plugins):
 def _run_obs(cfg, grab_png):
     obs = obsexec.OBSExec(config=cfg, run=True)
 
-    ui = obsui.OBSUI(obs.get_obsws())
+    ui = obs.get_ui()
     try:
         ui.request('widget-invoke', {
             'path': [
@@ -104,12 +158,19 @@ def _move_logs(cfg, dstdir, prefix):
 def run_firsttime(
         # pylint: disable=too-many-arguments
         *, configure=True, run=True, lang=None, obs=None, additional_plugins=None, size=None,
-        save_dst=None, grab_png=None, logs=None):
+        save_dst=None, grab_png=None, logs=None, install_obs=None, lockfile=None):
     '''Run the first time wizard and configure
+    :param install_obs:  Optional destination to download and install OBS Studio.
+                         It runs concurrently with the download of the plugins.
+    :param lockfile:     Optional path to the lockfile. Pinned releases are installed
+                         without GitHub API, and the others are pinned.
     '''
     if configure:
-        cfg = _prepare_config(obs=obs, additional_plugins=additional_plugins)
+        cfg = _prepare_config(obs=obs, additional_plugins=additional_plugins,
+                              install_obs=install_obs, lockfile=lockfile)
     else:
+        if install_obs:
+            _run_jobs([_install_obs_job(install_obs, obs=obs, lockfile=lockfile)])
         cfg = obsconfig.OBSConfig()
 
     if run:
@@ -149,6 +210,12 @@ def _get_args():
                         help='Print the asset information and exit')
     parser.add_argument('--obs', action='store', default=None,
                         help='OBS Studio version')
+    parser.add_argument('--install-obs', action='store', nargs='?', const='./obs-studio',
+                        default=None, metavar='DESTINATION',
+                        help='Also downloads and installs OBS Studio, default to ./obs-studio')
+    parser.add_argument('--lockfile', action='store', default=None,
+                        help='Install the releases pinned in the file, '
+                             'or pin the resolved releases with --info-only')
     parser.add_argument('--run', action=argparse.BooleanOptionalAction, default=True)
     parser.add_argument('--save', action='store', default=None,
                         help='Path to save the configuration directory')
@@ -177,7 +244,9 @@ def main():
         paths = _download_plugins(
             obs = args.obs,
             additional_plugins = args.plugins,
-            info_only=True
+            info_only=True,
+            install_obs = args.install_obs,
+            lockfile = args.lockfile,
         )
         for path in paths:
             print(path)
@@ -193,6 +262,8 @@ def main():
             size = args.size,
             grab_png = args.grab,
             logs = args.logs,
+            install_obs = args.install_obs,
+            lockfile = args.lockfile,
     )
 
     if args.run_again:
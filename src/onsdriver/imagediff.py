@@ -0,0 +1,286 @@
+'''
+Compare screenshots
+
+This module requires numpy, and Pillow to read or write image files.
+'''
+
+import collections
+import io
+import json
+import os
+import os.path
+import threading
+import numpy # pylint: disable=import-error
+
+# Constants of SSIM for 8-bit images.
+_SSIM_C1 = (0.01 * 255) ** 2
+_SSIM_C2 = (0.03 * 255) ** 2
+_SSIM_WINDOW = 7
+
+_PHASH_SIZE = 32
+_PHASH_LOW = 8
+
+_PHASH_FILE = '.onsdriver-phash.json'
+
+def load_image(src):
+    '''Return an image as a numpy array of RGB
+    :param src:  numpy array, bytes of PNG, PIL image or file name.
+    :return:     numpy array of uint8 in the shape (height, width, 3).
+    '''
+    if isinstance(src, numpy.ndarray):
+        if src.ndim == 2:
+            return numpy.repeat(src[:, :, None], 3, axis=2)
+        return src[:, :, :3]
+    from PIL import Image # pylint: disable=import-outside-toplevel
+    if isinstance(src, (bytes, bytearray)):
+        src = io.BytesIO(src)
+    if isinstance(src, Image.Image):
+        return numpy.asarray(src.convert('RGB'))
+    with Image.open(src) as img:
+        return numpy.asarray(img.convert('RGB'))
+
+def save_image(arr, filename):
+    'Save a numpy array of RGB to a file'
+    from PIL import Image # pylint: disable=import-outside-toplevel
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    Image.fromarray(arr).save(filename)
+
+def _luminance(img):
+    return img.astype(numpy.float64) @ numpy.array([0.299, 0.587, 0.114])
+
+def _box_mean(x, size):
+    'Mean of each window of size x size, by the summed-area table'
+    s = numpy.zeros((x.shape[0] + 1, x.shape[1] + 1))
+    s[1:, 1:] = x.cumsum(axis=0).cumsum(axis=1)
+    total = s[size:, size:] - s[:-size, size:] - s[size:, :-size] + s[:-size, :-size]
+    return total / (size * size)
+
+def ssim(a, b, window=_SSIM_WINDOW, valid=None):
+    '''Return the mean structural similarity of the luminance with a uniform window
+    :param a:       numpy array of RGB.
+    :param b:       numpy array of RGB in the same shape.
+    :param window:  Size of the window.
+    :param valid:   Optional boolean array of (height, width), true for pixels to compare.
+                    Only the windows fully inside the valid pixels are averaged.
+    :return:        Score up to 1.0 for identical images, or 1.0 if no window is valid.
+    '''
+    x, y = _luminance(a), _luminance(b)
+    size = min(window, x.shape[0], x.shape[1])
+    if size < 1:
+        return 1.0
+    mx, my = _box_mean(x, size), _box_mean(y, size)
+    vx = _box_mean(x * x, size) - mx * mx
+    vy = _box_mean(y * y, size) - my * my
+    cxy = _box_mean(x * y, size) - mx * my
+    s = ((2 * mx * my + _SSIM_C1) * (2 * cxy + _SSIM_C2)) / \
+            ((mx * mx + my * my + _SSIM_C1) * (vx + vy + _SSIM_C2))
+    if valid is not None:
+        inside = _box_mean(numpy.asarray(valid, dtype=numpy.float64), size) > 1 - 1e-9
+        if not inside.any():
+            return 1.0
+        s = s[inside]
+    return float(s.mean())
+
+def _dct_matrix(n):
+    k = numpy.arange(n)
+    m = numpy.cos(numpy.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    m[0] /= numpy.sqrt(2)
+    return m
+
+_DCT = _dct_matrix(_PHASH_SIZE)
+
+def _resize_mean(x, size):
+    'Resize a 2-D array by averaging the nearest rows and columns'
+    rows = numpy.linspace(0, x.shape[0], size + 1).astype(int)
+    cols = numpy.linspace(0, x.shape[1], size + 1).astype(int)
+    x = numpy.add.reduceat(x, rows[:-1], axis=0) / numpy.maximum(numpy.diff(rows), 1)[:, None]
+    x = numpy.add.reduceat(x, cols[:-1], axis=1) / numpy.maximum(numpy.diff(cols), 1)[None, :]
+    return x
+
+def phash(img):
+    '''Return the perceptual hash of an image
+    :param img:  numpy array of RGB, at least 32 pixels in each dimension.
+    :return:     64-bit integer.
+    '''
+    small = _resize_mean(_luminance(img), _PHASH_SIZE)
+    low = (_DCT @ small @ _DCT.T)[:_PHASH_LOW, :_PHASH_LOW].flatten()[1:]
+    bits = low > numpy.median(low)
+    return int(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+def hash_distance(h1, h2):
+    'Return the number of the different bits of two perceptual hashes'
+    return (h1 ^ h2).bit_count()
+
+class DiffResult:
+    'Result of `compare`'
+    # pylint: disable=too-many-instance-attributes,too-few-public-methods
+    def __init__(self, actual, expected, diff, exceed, ssim_score, max_diff_ratio):
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.actual = actual
+        self.expected = expected
+        self.diff = diff
+        self.exceed = exceed
+        self.n_diff_pixels = int(exceed.sum())
+        self.diff_ratio = self.n_diff_pixels / exceed.size if exceed.size else 0.0
+        self.max_diff = tuple(int(v) for v in diff.reshape(-1, diff.shape[-1]).max(axis=0)) \
+                if diff.size else (0, 0, 0)
+        self.ssim = ssim_score
+        self.passed = self.diff_ratio <= max_diff_ratio
+
+    def __bool__(self):
+        return self.passed
+
+    def __str__(self):
+        return (f'{self.n_diff_pixels} pixels ({self.diff_ratio:.4%}) differ, '
+                f'max diff {self.max_diff}, SSIM {self.ssim:.4f}')
+
+    def heatmap(self):
+        '''Return an image to show the difference
+        Differing pixels are drawn in red over the dimmed expected image.
+        :return:  numpy array of RGB.
+        '''
+        base = (_luminance(self.expected) * 0.3).astype(numpy.uint8)
+        img = numpy.repeat(base[:, :, None], 3, axis=2)
+        magnitude = self.diff.max(axis=2)
+        img[self.exceed, 0] = numpy.maximum(magnitude[self.exceed], 128)
+        img[self.exceed, 1] = 0
+        img[self.exceed, 2] = 0
+        return img
+
+    def save_heatmap(self, filename):
+        'Save the image returned by `heatmap`'
+        save_image(self.heatmap(), filename)
+
+def _region_mask(shape, mask, ignore):
+    valid = numpy.ones(shape[:2], dtype=bool) if mask is None else numpy.asarray(mask, dtype=bool)
+    if ignore:
+        valid = valid.copy()
+        for x, y, w, h in ignore:
+            valid[max(y, 0):y+h, max(x, 0):x+w] = False
+    return valid
+
+def compare(actual, expected, tolerance=0, *, mask=None, ignore=(), max_diff_ratio=0.0,
+            with_ssim=True):
+    # pylint: disable=too-many-arguments
+    '''Compare two images
+    :param actual:          Image, see `load_image`.
+    :param expected:        Image, see `load_image`.
+    :param tolerance:       Allowed difference of each channel, an integer or a tuple for R, G, B.
+    :param mask:            Optional boolean array of (height, width), true for pixels to compare.
+    :param ignore:          List of tuples of x, y, width and height of regions not to compare.
+    :param max_diff_ratio:  Allowed ratio of the differing pixels to pass.
+    :param with_ssim:       Calculate SSIM score.
+    :return:                DiffResult instance, which is true if passed.
+    :raises ValueError:     The sizes of the images or the mask differ.
+    '''
+    a = load_image(actual)
+    e = load_image(expected)
+    if a.shape != e.shape:
+        raise ValueError(f'Image size differs: {a.shape[1]}x{a.shape[0]} '
+                         f'expected {e.shape[1]}x{e.shape[0]}')
+    if mask is not None and numpy.shape(mask) != a.shape[:2]:
+        raise ValueError(f'Mask size differs: shape {numpy.shape(mask)} '
+                         f'expected {a.shape[:2]}')
+    diff = numpy.abs(a.astype(numpy.int16) - e.astype(numpy.int16)).astype(numpy.uint8)
+    valid = _region_mask(a.shape, mask, ignore)
+    diff[~valid] = 0
+    exceed = (diff > numpy.asarray(tolerance, dtype=numpy.int16)).any(axis=2)
+    ssim_score = ssim(a, e, valid=valid) if with_ssim else float('nan')
+    return DiffResult(a, e, diff, exceed, ssim_score, max_diff_ratio)
+
+class BaselineCache:
+    '''Baseline images in a directory
+
+    Decoded images are kept in memory up to `max_images`, and the perceptual hashes are saved
+    in the directory so that they are computed only when a baseline is added or updated.
+    '''
+    def __init__(self, dirname, max_images=64):
+        '''
+        :param dirname:     Directory of the baseline PNG files.
+        :param max_images:  Number of the decoded images to keep in memory.
+        '''
+        self.dirname = dirname
+        self.max_images = max_images
+        self._images = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hashes = {}
+        self._hashes_dirty = False
+        try:
+            with open(dirname + '/' + _PHASH_FILE, 'r', encoding='utf-8') as fr:
+                self._hashes = json.load(fr)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            pass
+
+    def _stat_key(self, name):
+        st = os.stat(self.dirname + '/' + name)
+        return [st.st_size, st.st_mtime_ns]
+
+    def get(self, name):
+        '''Return a baseline image
+        :param name:  File name in the directory.
+        :return:      numpy array of RGB.
+        '''
+        key = self._stat_key(name)
+        with self._lock:
+            cached = self._images.get(name)
+            if cached and cached[0] == key:
+                self._images.move_to_end(name)
+                return cached[1]
+        img = load_image(self.dirname + '/' + name)
+        with self._lock:
+            self._images[name] = (key, img)
+            while len(self._images) > self.max_images:
+                self._images.popitem(last=False)
+        return img
+
+    def get_hash(self, name):
+        'Return the perceptual hash of a baseline image'
+        key = self._stat_key(name)
+        with self._lock:
+            entry = self._hashes.get(name)
+            if entry and entry[0] == key:
+                return entry[1]
+        h = phash(self.get(name))
+        with self._lock:
+            self._hashes[name] = [key, h]
+            self._hashes_dirty = True
+        return h
+
+    def save(self):
+        'Save the perceptual hashes to the directory'
+        with self._lock:
+            if not self._hashes_dirty:
+                return
+            tmp = f'{self.dirname}/{_PHASH_FILE}.{os.getpid()}'
+            with open(tmp, 'w', encoding='utf-8') as fw:
+                json.dump(self._hashes, fw)
+            os.replace(tmp, self.dirname + '/' + _PHASH_FILE)
+            self._hashes_dirty = False
+
+    def names(self):
+        'Return a list of the baseline file names'
+        return sorted(name for name in os.listdir(self.dirname) if name.endswith('.png'))
+
+    def lookup(self, img, max_distance=8):
+        '''Find baselines similar to an image by the perceptual hash
+        :param img:           Image, see `load_image`.
+        :param max_distance:  Largest number of the different bits of the hash.
+        :return:              List of tuples of the distance and the name, nearest first.
+        '''
+        h = phash(load_image(img))
+        found = []
+        for name in self.names():
+            d = hash_distance(h, self.get_hash(name))
+            if d <= max_distance:
+                found.append((d, name))
+        self.save()
+        return sorted(found)
+
+    def compare(self, actual, name, **kwargs):
+        '''Compare an image with a baseline
+        :param actual:  Image, see `load_image`.
+        :param name:    File name of the baseline in the directory.
+        :param kwargs:  Arguments of `compare`.
+        :return:        DiffResult instance.
+        '''
+        return compare(actual, self.get(name), **kwargs)
@@ -2,29 +2,37 @@
 This module provides configuration directory access to test obs-studio.
 '''
 
+import atexit
 import configparser
 import os
 import os.path
 import random
 import shutil
+import socket
 import string
 import sys
 import tempfile
+import threading
 import json
 import copy
+from onsdriver import _provision
 
 _OBSWS_CONFIG_PATH = '/plugin_config/obs-websocket/config.json'
 
-def _get_config_dir():
+_OBSWS_DEFAULT_PORT = 4455
+
+def _get_config_dir(environ=None):
+    if environ is None:
+        environ = os.environ
     if sys.platform == 'linux':
         try:
-            return os.environ['XDG_CONFIG_HOME'] + '/obs-studio'
+            return environ['XDG_CONFIG_HOME'] + '/obs-studio'
         except KeyError:
-            return os.environ['HOME'] + '/.config/obs-studio'
+            return environ['HOME'] + '/.config/obs-studio'
     elif sys.platform == 'darwin':
-        return os.environ['HOME'] + '/Library/Application Support/obs-studio'
+        return environ['HOME'] + '/Library/Application Support/obs-studio'
     elif sys.platform == 'win32':
-        return os.environ['AppData'] + '/obs-studio'
+        return environ['AppData'] + '/obs-studio'
     else:
         raise NotImplementedError(f'Not supported platform: f{sys.platform}')
 
@@ -32,6 +40,28 @@ def _generate_password():
     cand = string.ascii_lowercase + string.digits + string.ascii_uppercase
     return ''.join([random.choice(cand) for i in range(0, 16)])
 
+def _find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+def isolated_by_default():
+    'Return true if `ONSDRIVER_ISOLATED` requests private configuration directories'
+    return bool(os.environ.get('ONSDRIVER_ISOLATED'))
+
+def get_instance_environ(root):
+    '''Return environment variables to give OBS Studio a private configuration directory
+    :param root:  Directory used as the home directory of the instance.
+    :return:      Dictionary of environment variables to be overwritten.
+    '''
+    if sys.platform == 'linux':
+        return {'XDG_CONFIG_HOME': root + '/.config'}
+    if sys.platform == 'darwin':
+        # NSSearchPathForDirectoriesInDomains ignores HOME but honors CFFIXED_USER_HOME.
+        return {'HOME': root, 'CFFIXED_USER_HOME': root}
+    # On Windows, OBS Studio takes AppData from the shell folder API, not from the environment.
+    raise NotImplementedError(f'Isolated instance is not supported on {sys.platform}')
+
 
 class TemporaryConfigContext:
     '''
@@ -114,18 +144,36 @@ class OBSConfig:
     '''
     Base class to access configuration directory for obs-studio.
     '''
-    def __init__(self):
-        self.path = _get_config_dir()
+    def __init__(self, isolated=False, root=None):
+        '''
+        :param isolated:  If true, use a private configuration directory under a new temporary
+                          directory so that multiple instances can run at the same time.
+        :param root:      Private root directory to use if isolated, instead of a new one.
+        '''
+        if isolated:
+            self.root = root or tempfile.mkdtemp(prefix='onsdriver-instance-')
+            self.environ = get_instance_environ(self.root)
+        else:
+            self.root = None
+            self.environ = {}
+        self.path = _get_config_dir(os.environ | self.environ)
         self._global_cfg = None
         self._user_cfg = None
 
+    def cleanup(self):
+        'Remove the private root directory if isolated'
+        if self.root:
+            shutil.rmtree(self.root, ignore_errors=True)
+            self.root = None
+
     def save(self, dst_path):
         '''
         Save the current state
         :param dst_path:  The path to save the state into.
         '''
         shutil.rmtree(dst_path, ignore_errors=True)
-        shutil.copytree(self.path + '/', dst_path, symlinks=True)
+        shutil.copytree(self.path + '/', dst_path, symlinks=True,
+                        ignore=shutil.ignore_patterns(_provision.MANIFEST_NAME))
 
     def get_global_cfg(self, section):
         'Return the global configuration'
@@ -210,13 +258,23 @@ class OBSConfig:
         except (FileNotFoundError, json.decoder.JSONDecodeError):
             return {}
 
-    def enable_obsws(self, auth_required=True):
-        'Enable websocket'
+    def get_obsws_port(self):
+        'Return the port number of obs-websocket'
+        return self.get_obsws_cfg().get('server_port', _OBSWS_DEFAULT_PORT)
+
+    def enable_obsws(self, auth_required=True, port=None):
+        '''Enable websocket
+        :param auth_required:  Require a password to connect.
+        :param port:           Port number. If not given, 4455 is used unless isolated,
+                               otherwise a free port is selected.
+        '''
+        if not port:
+            port = _find_free_port() if self.root else _OBSWS_DEFAULT_PORT
         config_obsws = self.get_obsws_cfg()
         orig = copy.deepcopy(config_obsws)
         config_obsws['first_load'] = False
         config_obsws['server_enabled'] = True
-        config_obsws['server_port'] = 4455
+        config_obsws['server_port'] = port
         config_obsws['alerts_enabled'] = False
         config_obsws['auth_required'] = bool(auth_required)
         if auth_required:
@@ -238,8 +296,60 @@ class OBSConfigCopyFromSaved(OBSConfig):
     '''
     Restores from a saved configuration and prepare to start obs-studio.
     '''
-    def __init__(self, src_path):
-        OBSConfig.__init__(self)
+    def __init__(self, src_path, isolated=False):
+        OBSConfig.__init__(self, isolated=isolated)
         self.remove_files()
         os.makedirs(os.path.dirname(self.path), mode=0o755, exist_ok=True)
         shutil.copytree(src_path + '/', self.path, symlinks=True)
+
+class OBSConfigLinkFromSaved(OBSConfig):
+    '''
+    Provisions from a saved configuration by reflinks or hardlinks, and prepare to start obs-studio.
+
+    Files that OBS Studio may modify, such as ini and json files and files under plugin_config,
+    are copied if reflink is not available. When the same configuration directory is provisioned
+    again, only files that are modified, added or removed since the last provisioning are
+    synchronized. The saved configuration must not be modified in place while it is in use.
+    RuntimeError is raised if a hard-linked file was modified, since it modified the saved
+    configuration too.
+
+    If isolated, the private root directory is not removed by `cleanup` but kept in the process
+    for the next instance of the same saved configuration, so that each test synchronizes only
+    the changed files. The roots are removed when the process exits.
+    '''
+    _free_roots = {}
+    _all_roots = []
+    _roots_lock = threading.Lock()
+
+    def __init__(self, src_path, isolated=False):
+        self._src_key = os.path.abspath(src_path)
+        OBSConfig.__init__(self, isolated=isolated,
+                           root=self._take_root(self._src_key) if isolated else None)
+        self.sync_stats = _provision.sync_tree(src_path, self.path)
+
+    @classmethod
+    def _take_root(cls, src_key):
+        with cls._roots_lock:
+            free = cls._free_roots.get(src_key)
+            if free:
+                return free.pop()
+            if not cls._all_roots:
+                atexit.register(cls._remove_roots)
+            root = tempfile.mkdtemp(prefix='onsdriver-linked-')
+            cls._all_roots.append(root)
+            return root
+
+    @classmethod
+    def _remove_roots(cls):
+        with cls._roots_lock:
+            for root in cls._all_roots:
+                shutil.rmtree(root, ignore_errors=True)
+            cls._all_roots.clear()
+            cls._free_roots.clear()
+
+    def cleanup(self):
+        'Keep the private root directory for the next instance if isolated'
+        if self.root:
+            with self._roots_lock:
+                self._free_roots.setdefault(self._src_key, []).append(self.root)
+            self.root = None
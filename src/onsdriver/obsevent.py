@@ -0,0 +1,166 @@
+'''
+Wait for obs-websocket events
+'''
+
+import threading
+import time
+import obsws_python
+
+class _Dispatcher:
+    # pylint: disable=too-few-public-methods
+    'Receive all events instead of obsws_python.callback.Callback'
+    def __init__(self, events):
+        self._events = events
+
+    def trigger(self, event_type, data):
+        'Called by obsws_python.EventClient for each event'
+        self._events._dispatch(event_type, data) # pylint: disable=protected-access
+
+class EventWaiter:
+    'An expected event registered before the action that triggers it'
+
+    def __init__(self, events, event_type, cond=None):
+        self._events = events
+        self.event_type = event_type
+        self.cond = cond
+        self.data = None
+        self.done = False
+
+    def _match(self, event_type, data):
+        if event_type != self.event_type:
+            return False
+        return not self.cond or self.cond(data)
+
+    def wait(self, timeout=10):
+        '''Wait for the event
+        :param timeout:  Timeout in second.
+        :return:         Dictionary of the event data.
+        '''
+        return self._events._wait(self, timeout) # pylint: disable=protected-access
+
+    def cancel(self):
+        'Stop waiting for the event'
+        self._events._remove(self) # pylint: disable=protected-access
+
+class OBSEvents:
+    '''Subscribe obs-websocket events and wait for them
+
+    Register the expectation by `expect` before the action, then wait for it,
+    so that an event that arrives quickly is not missed.
+    '''
+    def __init__(self, host='localhost', port=4455, password=None, subs=None):
+        '''
+        :param host:      Host name of obs-websocket.
+        :param port:      Port number of obs-websocket.
+        :param password:  Password of obs-websocket.
+        :param subs:      Event subscription flags, obsws_python.Subs.
+                          Default is all low-volume events.
+        '''
+        if subs is None:
+            subs = obsws_python.Subs.LOW_VOLUME
+        self._cv = threading.Condition()
+        self._waiters = []
+        self._handlers = []
+        self.client = obsws_python.EventClient(host=host, port=port, password=password, subs=subs)
+        self.client.callback = _Dispatcher(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        'Disconnect from obs-websocket'
+        if self.client:
+            self.client.disconnect()
+            self.client = None
+        with self._cv:
+            self._cv.notify_all()
+
+    def add_handler(self, handler):
+        '''Add a callable to be called for every event
+        :param handler:  Callable taking the event type and the event data.
+                         It is called from the background thread.
+        '''
+        with self._cv:
+            self._handlers.append(handler)
+
+    def remove_handler(self, handler):
+        'Remove a callable added by `add_handler`'
+        with self._cv:
+            self._handlers.remove(handler)
+
+    def _dispatch(self, event_type, data):
+        with self._cv:
+            handlers = list(self._handlers)
+            for w in self._waiters:
+                if not w.done and w._match(event_type, data): # pylint: disable=protected-access
+                    w.data = data
+                    w.done = True
+            self._waiters = [w for w in self._waiters if not w.done]
+            self._cv.notify_all()
+        for handler in handlers:
+            handler(event_type, data)
+
+    def _remove(self, waiter):
+        with self._cv:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def _wait(self, waiter, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cv:
+            while not waiter.done:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._connected():
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                    raise TimeoutError(f'Waiting event {waiter.event_type}')
+                # Wake up periodically to notice the connection is closed.
+                self._cv.wait(min(remaining, 0.5))
+        return waiter.data
+
+    def _connected(self):
+        return self.client is not None and self.client.worker.is_alive()
+
+    def expect(self, event_type, cond=None):
+        '''Register an event to wait for
+        :param event_type:  Event type such as 'CurrentProgramSceneChanged'.
+        :param cond:        Optional callable taking the event data to select the event.
+        :return:            EventWaiter instance.
+        '''
+        waiter = EventWaiter(self, event_type, cond)
+        with self._cv:
+            self._waiters.append(waiter)
+        return waiter
+
+    def wait(self, event_type, cond=None, timeout=10):
+        '''Wait for an event that arrives after this call
+        :param event_type:  Event type.
+        :param cond:        Optional callable taking the event data to select the event.
+        :param timeout:     Timeout in second.
+        :return:            Dictionary of the event data.
+        '''
+        return self.expect(event_type, cond).wait(timeout)
+
+    def expect_scene(self, scene_name=None):
+        '''Register a change of the program scene to wait for
+        :param scene_name:  Optional scene name to wait for.
+        '''
+        def _cond(data):
+            return not scene_name or data.get('sceneName') == scene_name
+        return self.expect('CurrentProgramSceneChanged', _cond)
+
+    def expect_vendor_event(self, vendor_name, event_type=None):
+        '''Register a custom event emitted by a plugin to wait for
+        :param vendor_name:  Vendor name of the plugin.
+        :param event_type:   Optional event type defined by the vendor.
+        :return:             EventWaiter instance, `wait` returns the whole event data
+                             including 'eventData'.
+        '''
+        def _cond(data):
+            if data.get('vendorName') != vendor_name:
+                return False
+            return not event_type or data.get('eventType') == event_type
+        return self.expect('VendorEvent', _cond)
@@ -2,15 +2,18 @@
 This module provides a functionality to execute obs-studio.
 '''
 
+import json
 import os
 import os.path
+import platform
 import re
 import sys
 import subprocess
-import tempfile
 import time
 import obsws_python
-from onsdriver import obsconfig, obsui, util
+from onsdriver import obsconfig, obsevent, obsui, util, _cache
+from onsdriver._logfollow import LogFollower
+from onsdriver._stderr import StderrMonitor
 from onsdriver.xvfb_run import xvfb_run
 
 _WAIVED_ERRORS_RE_LIST = (
@@ -27,6 +30,39 @@ _WAIVED_ERRORS_RE_LIST = (
 
 _WAIVED_ERRORS_RE = re.compile('(' + '|'.join(_WAIVED_ERRORS_RE_LIST) + ')')
 
+class StartupTiming:
+    '''Timestamps of the startup phases
+
+    Each phase is recorded as seconds since `OBSExec.run` was called, measured by a monotonic clock.
+    Phases are 'xvfb', 'spawn', 'log_created', 'scene_switched', 'obsws_connected',
+    and 'window_visible'.
+    '''
+    def __init__(self, exec_path=None):
+        self.start = time.monotonic()
+        self.phases = {}
+        self.info = {
+                'exec_path': exec_path,
+                'platform': sys.platform,
+                'node': platform.node(),
+                'time': time.time(),
+        }
+
+    def mark(self, phase):
+        'Record the current time for the phase if not recorded yet'
+        if phase not in self.phases:
+            self.phases[phase] = time.monotonic() - self.start
+
+    def as_dict(self):
+        'Return a dictionary to be serialized'
+        return self.info | {'phases': dict(self.phases)}
+
+    def save(self, path):
+        '''Save the record as JSON
+        :param path:  Path to the JSON file.
+        '''
+        with open(path, 'w', encoding='utf-8') as fw:
+            json.dump(self.as_dict(), fw, indent=1)
+
 def _normalize_exec_path(path):
     if sys.platform == 'darwin':
         candidates = (
@@ -45,6 +81,23 @@ def _normalize_exec_path(path):
             return cand
     return None
 
+def find_exec_path(path):
+    '''Return the executable file in an installation of OBS Studio
+    :param path:  Directory of the installation, the app bundle, or the executable file.
+    :return:      Path to the executable file, or None if not found.
+    '''
+    if sys.platform == 'darwin':
+        candidates = (path + '/OBS.app', path)
+    elif sys.platform == 'linux':
+        candidates = (path + '/bin/obs', path)
+    else:
+        candidates = (path, )
+    for cand in candidates:
+        exec_path = _normalize_exec_path(cand)
+        if exec_path and os.path.isfile(exec_path):
+            return exec_path
+    return None
+
 def get_exec_path():
     'Return the executable file path of OBS'
     if 'OBS_EXEC' in os.environ:
@@ -72,9 +125,82 @@ def get_exec_path():
 
     raise ValueError(f'Cannot find obs-studio executable path for {sys.platform}')
 
+def _prepare_exec(exec_path, config, timing):
+    '''Prepare to start the process
+    :return:  Tuple of the command, the working directory, and the environment variables.
+    '''
+    # Keep the extracted tree in use from being the least recently used one.
+    _cache.touch_tree(exec_path)
+    if sys.platform == 'linux':
+        proc_cwd = None
+        cmd = [exec_path]
+        if 'DISPLAY' not in os.environ or not os.environ['DISPLAY']:
+            xvfb_run()
+            timing.mark('xvfb')
+    elif sys.platform == 'win32':
+        proc_cwd = os.path.dirname(exec_path)
+        cmd = [os.path.abspath(exec_path)]
+    else:
+        proc_cwd = None
+        cmd = [exec_path]
+
+    env = os.environ | config.environ if config.environ else None
+    return cmd, proc_cwd, env
+
+def _check_exit(exit_code, stderr, check_error):
+    if exit_code != 0:
+        if stderr:
+            for line in stderr.get_context():
+                print(line)
+        raise OSError(f'OBS exit with code {exit_code}')
+
+    if stderr:
+        errors = stderr.get_errors()
+        for line in errors:
+            sys.stderr.write(line + '\n')
+        if errors and check_error:
+            raise OSError('OBS has error in log.')
+
+def _shutdown_request():
+    return {
+        'vendorName': 'shutdown-plugin',
+        'requestType': 'shutdown',
+        'requestData': {
+            'reason': f'requested through onsdriver by {sys.argv[0]}',
+            'support_url': 'https://github.com/noris-plugins-for-obs/onsdriver/issues',
+            'force': True,
+            'exit_timeout': 5.0,
+        }
+    }
+
+def _get_obsws_passwd(config):
+    cfg = config.get_obsws_cfg()
+    try:
+        if cfg['auth_required']:
+            return cfg['server_password']
+        return None
+    except KeyError:
+        return None
+
 class OBSExec:
+    # pylint: disable=too-many-instance-attributes
     'Class to run OBS Studio'
-    def __init__(self, config=None, run=True, exec_path=None, enable_obsws=True):
+    def __init__(
+            # pylint: disable=too-many-arguments
+            self, config=None, run=True, exec_path=None, enable_obsws=True, *, on_error=None,
+            save_timing=None):
+        '''
+        :param config:        OBSConfig instance.
+        :param run:           Start OBS Studio now.
+        :param exec_path:     Path to the executable file.
+        :param enable_obsws:  Enable obs-websocket in the configuration.
+        :param on_error:      Optional callable to be called with each non-waived error line
+                              in stderr as soon as it arrives, from a background thread.
+                              An exception from it is raised later by `check_errors`.
+        :param save_timing:   Save the startup timing as JSON next to the log file.
+                              Default is true if the environment variable `ONSDRIVER_TIMING`
+                              is set to a non-empty value.
+        '''
         if not config:
             config = obsconfig.OBSConfig()
 
@@ -86,7 +212,12 @@ class OBSExec:
         self.config = config
         self.proc_obs = None
         self._obsws = None
-        self._tmp_stderr = None
+        self.stderr = None
+        self.on_error = on_error
+        self.timing = None
+        if save_timing is None:
+            save_timing = bool(os.environ.get('ONSDRIVER_TIMING'))
+        self.save_timing = save_timing
 
         if enable_obsws:
             config.enable_obsws()
@@ -96,79 +227,87 @@ class OBSExec:
     def run(self):
         'Start OBS Studio'
         self._obsws = None
+        self.timing = StartupTiming(exec_path=self.exec_path)
 
         self.config.remove_logs()
 
-        if sys.platform == 'linux':
-            proc_cwd = None
-            cmd = [self.exec_path]
-            if 'DISPLAY' not in os.environ or not os.environ['DISPLAY']:
-                xvfb_run()
-        elif sys.platform == 'win32':
-            proc_cwd = os.path.dirname(self.exec_path)
-            cmd = [os.path.abspath(self.exec_path)]
-        else:
-            proc_cwd = None
-            cmd = [self.exec_path]
+        cmd, proc_cwd, env = _prepare_exec(self.exec_path, self.config, self.timing)
 
         # pylint: disable=consider-using-with
-        self._tmp_stderr = tempfile.TemporaryFile()
         self.proc_obs = subprocess.Popen(
                 cmd,
                 stdout = subprocess.DEVNULL,
-                stderr = self._tmp_stderr,
+                stderr = subprocess.PIPE,
                 cwd = proc_cwd,
+                env = env,
         )
+        self.stderr = StderrMonitor(self.proc_obs.stderr, _WAIVED_ERRORS_RE, on_error=self.on_error)
+        self.timing.mark('spawn')
 
         try:
             self._run_ensure_startup()
         except Exception as e:
             if self.proc_obs.poll():
                 print(f'OBS process exit with code {self.proc_obs.returncode} during startup')
-            self._tmp_stderr.seek(0)
-            for line in self._tmp_stderr.read().decode('utf-8').split('\n'):
+            for line in self.stderr.get_context():
                 print(line)
             raise e
+        finally:
+            if self.save_timing:
+                self._save_timing()
+
+    def get_timing_file(self):
+        'Return the path of the startup timing file for the latest log file'
+        try:
+            logfile = self.get_logfile()
+        except FileNotFoundError:
+            return None
+        if not logfile:
+            return None
+        return os.path.splitext(logfile)[0] + '.timing.json'
+
+    def _save_timing(self):
+        path = self.get_timing_file()
+        if path:
+            self.timing.save(path)
 
     def _run_ensure_startup(self):
         # Wait startup
         # macOS: mac-avcapture-legacy takes up to 5 seconds.
         # Windows: Sometimes starting EXE takes 10 seconds.
-        time.sleep(0.2)
         if sys.platform == 'win32':
             timeout = 25
             wait = 0.5
         else:
             timeout = 10
             wait = 0.1
-        for _ in util.retry(timeout=timeout, each_wait=wait, error_msg='Checking startup by log'):
-            if self._obs_started():
-                break
+        with LogFollower(self.config.path + '/logs', proc=self.proc_obs, poll_interval=wait,
+                         on_open=lambda _: self.timing.mark('log_created')) as f:
+            f.wait_for('Switched to scene', timeout=timeout, error_msg='Checking startup by log')
+        self.timing.mark('scene_switched')
 
         cfg = self.config.get_obsws_cfg()
         if 'server_enabled' in cfg and cfg['server_enabled']:
             cl = self.get_obsws()
-            ui = obsui.OBSUI(cl)
+            ui = self.get_ui()
 
             # Ensure the main window is visible,
             # If not, ie. websocket request goes too early, UI will be corrupted.
-            for _ in util.retry(timeout=10, error_msg='Waiting main window is visible'):
+            def _visible():
                 try:
-                    res = ui.request('widget-list', {})
-                    if res['visible']:
-                        break
+                    return ui.request('widget-list', {})['visible']
                 except obsws_python.error.OBSSDKRequestError as e:
                     if e.code != 207: # OBS is not ready to perform the request.
                         raise e
+                return False
+            util.wait_until(_visible, timeout=10, procs=[self.proc_obs],
+                            backoff=util.Backoff(initial=0.02, cap=0.2),
+                            error_msg='Waiting main window is visible')
+            self.timing.mark('window_visible')
+            self.timing.info['obs_version'] = cl.get_version().obs_version
 
     def _get_obsws_passwd(self):
-        cfg = self.config.get_obsws_cfg()
-        try:
-            if cfg['auth_required']:
-                return cfg['server_password']
-            return None
-        except KeyError:
-            return None
+        return _get_obsws_passwd(self.config)
 
     def get_obsws(self, use_cache=True):
         '''Return an instance of obsws_python.ReqClient
@@ -185,17 +324,23 @@ class OBSExec:
         if not self.proc_obs:
             raise RuntimeError('OBS is not started')
 
-        for attempt in util.retry(timeout=5, error_msg='connecting to websocket'):
+        port = self.config.get_obsws_port()
+        stats = util.WaitStats()
+        def _connect():
             try:
                 pw = self._get_obsws_passwd()
-                self._obsws = obsws_python.ReqClient(host='localhost', port=4455, password=pw)
-                if sys.platform == 'linux' and attempt.count >= 2:
-                    print(f'Info: Succeeded to connect websocket after {attempt}.')
-                    sys.stdout.flush()
-                return self._obsws
-            except ConnectionRefusedError as e:
-                attempt.set_error(str(e))
-        raise NotImplementedError()
+                return obsws_python.ReqClient(host='localhost', port=port, password=pw)
+            except ConnectionRefusedError:
+                return None
+        self._obsws = util.wait_until(_connect, timeout=5, stats=stats,
+                                      backoff=util.Backoff(initial=0.02, cap=0.5),
+                                      error_msg='connecting to websocket')
+        if self.timing:
+            self.timing.mark('obsws_connected')
+        if sys.platform == 'linux' and stats.attempts >= 2:
+            print(f'Info: Succeeded to connect websocket after {stats}.')
+            sys.stdout.flush()
+        return self._obsws
 
     def close_ws(self):
         'Close the last websocket client to prepare shutdown'
@@ -206,44 +351,88 @@ class OBSExec:
     def get_logfile(self):
         'Return the latest log file path'
         logsdir = self.config.path + '/logs/'
-        logs = os.listdir(logsdir)
+        logs = [f for f in os.listdir(logsdir) if f.endswith('.txt')]
         if not logs:
             return None
         return logsdir + max(logs)
 
-    def _obs_started(self):
-        try:
-            log = self.get_logfile()
-            if not log:
-                return False
-            with open(log, 'r', encoding='utf-8') as fr:
-                for line in fr:
-                    if 'Switched to scene' in line:
-                        return True
-        except FileNotFoundError:
-            pass
-        return False
+    def get_ui(self):
+        '''Return an instance of onsdriver.obsui.OBSUI
+        The instance is tied to the client returned by `get_obsws`.
+        '''
+        return obsui.OBSUI(self.get_obsws())
 
-    def shutdown(self, wait=True):
-        'Shutdown OBS Studio'
+    def get_obsevents(self, subs=None):
+        '''Return a new instance of onsdriver.obsevent.OBSEvents
+        The caller should close the instance.
+        :param subs:  Event subscription flags, obsws_python.Subs.
+        '''
+        if not self.proc_obs:
+            raise RuntimeError('OBS is not started')
+        return obsevent.OBSEvents(port=self.config.get_obsws_port(),
+                                  password=self._get_obsws_passwd(), subs=subs)
+
+    def shutdown(self, wait=True, exit_timeout=10):
+        '''Shutdown OBS Studio
+        :param wait:          Wait until the process exits.
+        :param exit_timeout:  If waiting, seconds to wait for OBS to start exiting.
+                              If OBS does not start exiting, the process is killed.
+        '''
         cl = self.get_obsws()
-        res = cl.send('CallVendorRequest', {
-            'vendorName': 'shutdown-plugin',
-            'requestType': 'shutdown',
-            'requestData': {
-                'reason': f'requested through onsdriver by {sys.argv[0]}',
-                'support_url': 'https://github.com/noris-plugins-for-obs/onsdriver/issues',
-                'force': True,
-                'exit_timeout': 5.0,
-            }
-        })
-        if res.response_data != {}:
-            raise ValueError(f'shutdown request returned {res.response_data}')
-        del cl
+        events = self.get_obsevents(subs=obsws_python.Subs.GENERAL) if wait else None
+        try:
+            exit_started = events.expect('ExitStarted') if events else None
+            # Let the requests sent by `OBSUI.submit` finish before the shutdown.
+            obsui.OBSUI(cl).flush()
+            res = cl.send('CallVendorRequest', _shutdown_request())
+            if res.response_data != {}:
+                raise ValueError(f'shutdown request returned {res.response_data}')
+            del cl
+            if exit_started:
+                try:
+                    exit_started.wait(timeout=exit_timeout)
+                except TimeoutError:
+                    # The event might be lost if the connection was closed by the exit.
+                    try:
+                        self.proc_obs.wait(timeout=5)
+                    except subprocess.TimeoutExpired:
+                        self.proc_obs.kill()
+                        self.proc_obs.wait()
+                        raise OSError('OBS did not start exiting, killed') from None
+        finally:
+            if events:
+                events.close()
         if wait:
             return self.wait()
         return None
 
+    def get_errors(self):
+        'Return a list of error lines in stderr that are not waived'
+        if not self.stderr:
+            return []
+        return self.stderr.get_errors()
+
+    def check_errors(self):
+        '''Raise OSError if stderr has an error line that is not waived
+        If `on_error` has raised an exception, the exception is raised instead.
+        '''
+        if self.stderr:
+            self.stderr.raise_on_error()
+
+    def get_memory_leaks(self):
+        'Return the number of memory leaks in the last log, or -1 if not found.'
+        try:
+            logfile = self.get_logfile()
+        except FileNotFoundError:
+            return -1
+        if not logfile:
+            return -1
+        with open(logfile, encoding='utf-8') as fr:
+            for l in fr:
+                if 'Number of memory leaks:' in l:
+                    return int(l.rsplit(' ', 1)[-1])
+        return -1
+
     def wait(self, check_error=True):
         'Wait OBS to exit'
         self.close_ws()
@@ -251,22 +440,6 @@ class OBSExec:
         if not self.proc_obs:
             return
         exit_code = self.proc_obs.wait()
-        if exit_code != 0:
-            self._tmp_stderr.seek(0)
-            for line in self._tmp_stderr.read().decode('utf-8').split('\n'):
-                print(line)
-            raise OSError(f'OBS exit with code {exit_code}')
-
-        if self._tmp_stderr:
-            self._tmp_stderr.seek(0)
-            has_error = False
-            for line in self._tmp_stderr.read().decode('utf-8').split('\n'):
-                if _WAIVED_ERRORS_RE.match(line):
-                    continue
-                if line.startswith('error: '):
-                    has_error = True
-                    sys.stderr.write(line + '\n')
-            self._tmp_stderr.close()
-            self._tmp_stderr = None
-            if has_error and check_error:
-                raise OSError('OBS has error in log.')
+        if self.stderr and not self.stderr.join(timeout=5):
+            sys.stderr.write('Warning: stderr of OBS is still open after exit.\n')
+        _check_exit(exit_code, self.stderr, check_error)
@@ -3,33 +3,139 @@ Download and extract OBS Studio from GitHub
 '''
 
 import argparse
+import hashlib
+import json
+import os
+import os.path
+import re
 import shutil
 import sys
 import subprocess
+import time
 import zipfile
-from onsdriver import util
+from concurrent.futures import ThreadPoolExecutor
+from onsdriver import cache, util, _cache, _provision
 from onsdriver._ghutil import download_asset_with_file_re
 
 
 _OBS_REPO = 'https://github.com/obsproject/obs-studio'
 
+_SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+def _package_digest(pkg_path):
+    'Return SHA-256 of the package, the name of the cache entry if it is the digest'
+    key = os.path.basename(os.path.dirname(os.path.abspath(pkg_path)))
+    if _SHA256_RE.match(key):
+        return key
+    with open(pkg_path, 'rb') as fr:
+        return hashlib.file_digest(fr, 'sha256').hexdigest()
+
+def _extract_members(pkg_path, infos, destination):
+    with zipfile.ZipFile(pkg_path) as z:
+        for info in infos:
+            z.extract(info, destination)
+
+def _extract_zip(pkg_path, destination, max_workers=None):
+    '''Extract a zip file by threads
+    Each thread opens the file and extracts a part of the members, balanced by the size.
+    '''
+    max_workers = max_workers or min(8, os.cpu_count() or 1)
+    with zipfile.ZipFile(pkg_path) as z:
+        infos = z.infolist()
+    # Directories are created in advance since the threads would race to create them.
+    # Names are sanitized in the same way as `ZipFile.extract`.
+    os.makedirs(destination, exist_ok=True)
+    for info in infos:
+        name = info.filename if info.is_dir() else info.filename.rpartition('/')[0]
+        parts = [x for x in name.split('/') if x not in ('', '.', '..')]
+        if parts:
+            os.makedirs(os.path.join(destination, *parts), exist_ok=True)
+    groups = [[] for _ in range(max_workers)]
+    loads = [0] * max_workers
+    for info in sorted(infos, key=lambda i: i.compress_size, reverse=True):
+        i = loads.index(min(loads))
+        groups[i].append(info)
+        loads[i] += info.compress_size
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_extract_members, pkg_path, group, destination)
+                   for group in groups if group]
+        for f in futures:
+            f.result()
+
 def _extract(pkg_path, destination):
     if pkg_path.endswith('.zip'):
-        with zipfile.ZipFile(pkg_path) as z:
-            z.extractall(destination)
+        _extract_zip(pkg_path, destination)
     elif pkg_path.endswith('.dmg') and sys.platform == 'darwin':
         import dmglib # pylint: disable=import-outside-toplevel,import-error
         with dmglib.attachedDiskImage(pkg_path) as mount_points:
             shutil.copytree(mount_points[0], destination, symlinks=True)
     else:
         subprocess.run(['7z', 'x', '-o'+destination, pkg_path], check=True)
-    util.ignore_directory(destination)
+
+def _extract_to_store(pkg_path):
+    '''Extract the package into the store unless it is already extracted
+    The extracted tree is made read-only since it is shared by the installations.
+    :return:  Path to the extracted tree.
+    '''
+    digest = _package_digest(pkg_path)
+    cache_dir = _cache.prepare_cache_dir()
+    path = f'{cache_dir}/{_cache.EXTRACT_DIR}/{digest}'
+    os.makedirs(f'{cache_dir}/{_cache.EXTRACT_DIR}', exist_ok=True)
+    with _cache.entry_lock(path):
+        if os.path.exists(f'{path}/{_cache.EXTRACT_MANIFEST}'):
+            os.utime(path)
+            return path
+        _cache.remove_tree(path)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        _cache.remove_tree(tmp)
+        t0 = time.time()
+        _extract(pkg_path, tmp)
+        with open(f'{tmp}/{_cache.EXTRACT_MANIFEST}', 'w', encoding='utf-8') as fw:
+            json.dump({
+                'package': os.path.basename(pkg_path),
+                'digest': digest,
+                'time': time.time(),
+                'duration': time.time() - t0,
+            }, fw)
+        _cache.make_read_only(tmp)
+        os.replace(tmp, path)
+
+    max_size = cache.get_max_size()
+    if max_size is not None:
+        cache.prune(max_size, keep=(path, ))
+    return path
+
+def _switch(src, destination):
+    '''Make the destination point to the extracted tree
+    The destination becomes a symbolic link to the read-only tree if it is a symbolic link or
+    does not exist. The link is registered in the cache so that the tree is not pruned while
+    it is linked. Otherwise, or on Windows, where legacy plugins are extracted into the
+    installation, files are reflinked or copied by `sync_tree` so that the destination is
+    writable without modifying the store.
+    '''
+    _cache.touch_tree(src)
+    if sys.platform != 'win32' and \
+            (os.path.islink(destination) or not os.path.lexists(destination)):
+        tmp = f'{destination}.{os.getpid()}.tmp'
+        try:
+            os.symlink(os.path.abspath(src), tmp, target_is_directory=True)
+            os.replace(tmp, destination)
+            _cache.register_link(destination)
+            return 'symlinked'
+        except OSError:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+    if os.path.islink(destination):
+        os.remove(destination)
+    return str(_provision.sync_tree(src, destination, hardlink=False))
 
 def install_obs(
-        destination='./obs-studio', selector_re=None, info_only=False, version_specs=None):
+        destination='./obs-studio', selector_re=None, info_only=False, version_specs=None,
+        lockfile=None):
     '''Download OBS Studio from GitHub release and install it.
     :param destination:  Destination to extract OBS Studio.
     :param selector_re:  Regular expression to select the file.
+    :param lockfile:     Optional path to the lockfile to pin the release.
     '''
 
     if not selector_re:
@@ -41,11 +147,15 @@ def install_obs(
             raise NotImplementedError(f'Not supported platform: {sys.platform}')
 
     pkg_path = download_asset_with_file_re(
-            _OBS_REPO, selector_re, info_only=info_only, version_specs=version_specs)
+            _OBS_REPO, selector_re, info_only=info_only, version_specs=version_specs,
+            lockfile=lockfile)
     if info_only:
         return pkg_path
 
-    _extract(pkg_path=pkg_path, destination=destination)
+    src = _extract_to_store(pkg_path)
+    sys.stderr.write(f'Info: Installed {os.path.basename(src)[:12]} to {destination}: '
+                     f'{_switch(src, destination)}\n')
+    util.ignore_directory(destination)
     return None
 
 
@@ -55,6 +165,9 @@ def _get_args():
     parser.add_argument('--info-only', action='store_true', default=None,
                         help='Print the asset information and exit')
     parser.add_argument('--version-specs', action='store', default=None)
+    parser.add_argument('--lockfile', action='store', default=None,
+                        help='Install the release pinned in the file, '
+                             'or pin the resolved release with --info-only')
     args = parser.parse_args()
     return args
 
@@ -63,10 +176,12 @@ def main():
     args = _get_args()
 
     ret = install_obs(destination=args.destination, info_only=args.info_only,
-                      version_specs=args.version_specs)
+                      version_specs=args.version_specs, lockfile=args.lockfile)
 
     if args.info_only:
         print(ret)
+    else:
+        sys.stderr.write(f'Info: Download cache: {_cache.STATS}\n')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,258 @@
+'''
+Keep multiple versions of OBS Studio side by side and run a test suite against each of them
+'''
+
+import argparse
+import json
+import os
+import os.path
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from packaging.version import InvalidVersion, Version
+from onsdriver import obsexec, obsinstall, util, _cache
+
+_DEFAULT_ROOT = './obs-versions'
+
+def _version_key(tag):
+    try:
+        return (0, Version(tag), tag)
+    except InvalidVersion:
+        return (1, Version('0'), tag)
+
+class VersionStore:
+    '''Versions of OBS Studio installed in a directory
+
+    Each version is a directory, or a symbolic link to the extracted package or to a local build,
+    named by the tag. Extracted packages linked by the versions are not pruned from the download
+    cache.
+    '''
+    def __init__(self, root=_DEFAULT_ROOT):
+        '''
+        :param root:  Directory to keep the versions.
+        '''
+        self.root = root
+
+    def path(self, tag):
+        'Return the path of a version'
+        if not tag or '/' in tag or '\\' in tag or tag.startswith('.'):
+            raise ValueError(f'Invalid tag: {tag}')
+        return f'{self.root}/{tag}'
+
+    def exec_path(self, tag):
+        '''Return the executable file of a version, which can be set to `OBS_EXEC`
+        :raises FileNotFoundError:  The executable file is not found.
+        '''
+        exec_path = obsexec.find_exec_path(os.path.abspath(self.path(tag)))
+        if not exec_path:
+            raise FileNotFoundError(f'No OBS Studio executable in {self.path(tag)}')
+        return exec_path
+
+    def versions(self):
+        'Return the installed tags, lowest version first'
+        if not os.path.isdir(self.root):
+            return []
+        tags = [name for name in os.listdir(self.root) if not name.startswith('.')]
+        return sorted(tags, key=_version_key)
+
+    def install(self, version_specs=None, selector_re=None):
+        '''Download and install a release unless it is already installed
+        :param version_specs:  Condition to select the version, default is the latest.
+        :param selector_re:    Regular expression to select the file.
+        :return:               The tag of the release.
+        '''
+        info = json.loads(obsinstall.install_obs(
+                selector_re=selector_re, info_only=True, version_specs=version_specs))
+        tag = info['tag_name']
+        if tag not in self.versions():
+            os.makedirs(self.root, exist_ok=True)
+            util.ignore_directory(self.root)
+            obsinstall.install_obs(
+                    destination=self.path(tag), selector_re=selector_re,
+                    version_specs=f'=={tag}')
+        else:
+            # Installed before the links were registered.
+            _cache.register_link(self.path(tag))
+        return tag
+
+    def add(self, tag, path):
+        '''Register a local build
+        :param tag:   Name of the version.
+        :param path:  Path to the build, the directory or the executable file.
+        '''
+        if not obsexec.find_exec_path(os.path.abspath(path)):
+            raise FileNotFoundError(f'No OBS Studio executable in {path}')
+        os.makedirs(self.root, exist_ok=True)
+        util.ignore_directory(self.root)
+        self.remove(tag)
+        os.symlink(os.path.abspath(path), self.path(tag))
+
+    def remove(self, tag):
+        '''Remove a version
+        The extracted package stays in the download cache, and can be pruned unless another
+        installation links to it.
+        '''
+        path = self.path(tag)
+        if os.path.islink(path):
+            os.remove(path)
+        elif os.path.isdir(path):
+            shutil.rmtree(path)
+
+class MatrixResult:
+    # pylint: disable=too-few-public-methods
+    'Result of the command run against a version'
+    def __init__(self, tag, returncode, duration, log):
+        self.tag = tag
+        self.returncode = returncode
+        self.duration = duration
+        self.log = log
+
+    @property
+    def status(self):
+        'Return "passed", "FAILED", or "TIMEOUT"'
+        if self.returncode is None:
+            return 'TIMEOUT'
+        return 'passed' if self.returncode == 0 else 'FAILED'
+
+def _matrix_environ(exec_path, tag, logs_dir):
+    env = os.environ | {
+            'OBS_EXEC': exec_path,
+            'ONSDRIVER_LOGS': os.path.abspath(logs_dir),
+            'ONSDRIVER_OBS_VERSION': tag,
+    }
+    if sys.platform != 'win32':
+        env['ONSDRIVER_ISOLATED'] = '1'
+    if sys.platform == 'linux':
+        # Let each run start its own Xvfb.
+        env.pop('DISPLAY', None)
+        env.pop('XAUTHORITY', None)
+    return env
+
+def _kill_tree(proc):
+    if sys.platform == 'win32':
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(proc.pid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    proc.kill()
+    proc.wait()
+
+def _run_one(command, exec_path, tag, logs, timeout):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    logs_dir = f'{logs}/{tag}'
+    os.makedirs(logs_dir, exist_ok=True)
+    log = f'{logs_dir}/output.log'
+    t0 = time.monotonic()
+    with open(log, 'wb') as fw, subprocess.Popen(
+            command, env=_matrix_environ(exec_path, tag, logs_dir),
+            stdin=subprocess.DEVNULL, stdout=fw, stderr=subprocess.STDOUT,
+            start_new_session=True) as proc:
+        try:
+            returncode = proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            # Kill OBS and Xvfb started by the command too.
+            _kill_tree(proc)
+            returncode = None
+    result = MatrixResult(tag, returncode, time.monotonic() - t0, log)
+    sys.stderr.write(f'Info: {tag}: {result.status} in {result.duration:.1f}s\n')
+    return result
+
+def run_matrix(command, store=None, tags=None, max_workers=None, logs=None, timeout=None):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    '''Run a command against each version concurrently
+    Each run has `OBS_EXEC` set to the version, a private configuration directory by
+    `ONSDRIVER_ISOLATED`, its own Xvfb on Linux, and the logs under `logs/<tag>`.
+    :param command:      List of the command and the arguments, such as a test runner.
+    :param store:        VersionStore instance.
+    :param tags:         List of the tags to run, default is all installed versions.
+    :param max_workers:  Number of the concurrent runs. Runs are serialized on Windows since
+                         the configuration directory cannot be private.
+    :param logs:         Directory to keep the logs, default is `ONSDRIVER_LOGS`.
+    :param timeout:      Optional timeout in seconds for each run.
+    :return:             List of MatrixResult instances in the order of the tags.
+    :raises FileNotFoundError:  The executable file of a version is not found.
+    '''
+    store = store or VersionStore()
+    tags = tags or store.versions()
+    if not tags:
+        raise ValueError(f'No versions in {store.root}')
+    exec_paths = {tag: store.exec_path(tag) for tag in tags}
+    if sys.platform == 'win32':
+        max_workers = 1
+    logs = logs or util.get_logs_dir()
+    with ThreadPoolExecutor(max_workers=max_workers or len(tags)) as executor:
+        futures = [executor.submit(_run_one, command, exec_paths[tag], tag, logs, timeout)
+                   for tag in tags]
+        return [f.result() for f in futures]
+
+def format_table(results):
+    'Return a text table of the results'
+    width = max([len('version')] + [len(r.tag) for r in results])
+    lines = [f'{"version":{width}}  {"result":7}  {"time":>8}  log']
+    for r in results:
+        lines.append(f'{r.tag:{width}}  {r.status:7}  {r.duration:7.1f}s  {r.log}')
+    return '\n'.join(lines)
+
+def _get_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--root', action='store', default=_DEFAULT_ROOT,
+                        help=f'Directory of the versions, default {_DEFAULT_ROOT}')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help='List installed versions')
+    p = sub.add_parser('install', help='Download and install releases')
+    p.add_argument('version_specs', nargs='*', default=[None],
+                   help='Conditions such as "==30.*", default is the latest release')
+    p = sub.add_parser('add', help='Register a local build')
+    p.add_argument('tag')
+    p.add_argument('path')
+    p = sub.add_parser('remove', help='Remove versions')
+    p.add_argument('tags', nargs='+')
+    p = sub.add_parser('run', help='Run a command against each version')
+    p.add_argument('--versions', nargs='+', default=None,
+                   help='Tags to run, default is all installed versions')
+    p.add_argument('-j', '--jobs', action='store', type=int, default=None)
+    p.add_argument('--logs', action='store', default=None,
+                   help='Directory to keep the logs of each version')
+    p.add_argument('--timeout', action='store', type=float, default=None)
+    p.add_argument('args', nargs=argparse.REMAINDER,
+                   help='Command to run, such as "-- python -m unittest"')
+    return parser.parse_args()
+
+def main():
+    'Entry point'
+    args = _get_args()
+    store = VersionStore(args.root)
+
+    if args.command == 'list':
+        for tag in store.versions():
+            print(f'{tag}  {os.path.realpath(store.path(tag))}')
+
+    elif args.command == 'install':
+        for specs in args.version_specs:
+            print(store.install(version_specs=specs))
+
+    elif args.command == 'add':
+        store.add(args.tag, args.path)
+
+    elif args.command == 'remove':
+        for tag in args.tags:
+            store.remove(tag)
+
+    elif args.command == 'run':
+        command = args.args[1:] if args.args[:1] == ['--'] else args.args
+        if not command:
+            sys.exit('Error: Specify the command to run')
+        results = run_matrix(command, store=store, tags=args.versions, max_workers=args.jobs,
+                             logs=args.logs, timeout=args.timeout)
+        print(format_table(results))
+        if any(r.returncode != 0 for r in results):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
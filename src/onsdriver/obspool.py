@@ -0,0 +1,245 @@
+'''
+Pool of running OBS Studio instances reused across test cases
+'''
+
+import os
+import os.path
+import queue
+import shutil
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from onsdriver import obsconfig, obsexec, obsui, util
+
+# Name of the profile and the scene collection to switch to while restoring files.
+_SCRATCH_NAME = 'onsdriver-reset'
+
+class _Baseline:
+    # pylint: disable=too-few-public-methods
+    'Describes the state to restore an instance to'
+    def __init__(self, obs, src_path, index):
+        self.index = index
+        cl = obs.get_obsws()
+        cfg = obs.config
+        self.profile = cl.send('GetProfileList').current_profile_name
+        self.scene_collection = cl.send('GetSceneCollectionList').current_scene_collection_name
+
+        profile_dir = cfg.get_profile().path
+        self.profile_files = (
+                src_path + '/' + os.path.relpath(profile_dir, cfg.path),
+                profile_dir,
+        )
+        scene_file = cfg.get_scenecollection_file()
+        self.scene_collection_files = (
+                src_path + '/' + os.path.relpath(scene_file, cfg.path),
+                scene_file,
+        )
+
+def _restore_profile(cl, baseline):
+    profiles = cl.send('GetProfileList').profiles
+    if _SCRATCH_NAME in profiles:
+        cl.send('SetCurrentProfile', {'profileName': _SCRATCH_NAME})
+    else:
+        cl.send('CreateProfile', {'profileName': _SCRATCH_NAME})
+    src, dst = baseline.profile_files
+    shutil.rmtree(dst, ignore_errors=True)
+    shutil.copytree(src, dst, symlinks=True)
+    cl.send('SetCurrentProfile', {'profileName': baseline.profile})
+
+def _restore_scene_collection(cl, baseline):
+    collections = cl.send('GetSceneCollectionList').scene_collections
+    if _SCRATCH_NAME in collections:
+        cl.send('SetCurrentSceneCollection', {'sceneCollectionName': _SCRATCH_NAME})
+    else:
+        cl.send('CreateSceneCollection', {'sceneCollectionName': _SCRATCH_NAME})
+    # OBS saves the current scene collection when switching, so restore the file after that.
+    src, dst = baseline.scene_collection_files
+    shutil.copyfile(src, dst)
+    cl.send('SetCurrentSceneCollection', {'sceneCollectionName': baseline.scene_collection})
+
+class OBSPool:
+    # pylint: disable=too-many-instance-attributes
+    '''Pool of pre-started OBS Studio instances
+
+    A checked-in instance is reset to the saved configuration over the websocket.
+    It is restarted only if the reset fails, or if the instance has exited or reported an error.
+    Memory leaks are checked when the instance is shut down.
+    The problems found at a check-in are returned to the caller of `checkin`, and the others,
+    found when the pool is closed, are kept in `problems`.
+    '''
+    def __init__(self, config_name='saved-config', size=1, isolated=None, start=True):
+        '''
+        :param config_name:  Path to the saved configuration.
+        :param size:         Number of instances to keep running.
+        :param isolated:     Run each instance with a private configuration directory.
+                             Required and default if size is more than 1,
+                             or if `ONSDRIVER_ISOLATED` is set.
+        :param start:        Start the instances now.
+        '''
+        if isolated is None:
+            isolated = size > 1 or obsconfig.isolated_by_default()
+        if size > 1 and not isolated:
+            raise ValueError('Multiple instances require isolated configurations')
+        self.config_name = config_name
+        self.size = size
+        self.isolated = isolated
+        self.restarts = 0
+        self.problems = []
+        self._idle = queue.Queue()
+        self._baselines = {}
+        self._lock = threading.Lock()
+        self._n_started = 0
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='onsdriver-pool')
+        if start:
+            self.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(check=exc_type is None)
+
+    def start(self):
+        'Start instances in background'
+        for _ in range(self.size):
+            self._executor.submit(self._start_instance)
+
+    def _start_instance(self):
+        cfg = obs = None
+        try:
+            cfg = obsconfig.OBSConfigCopyFromSaved(self.config_name, isolated=self.isolated)
+            obs = obsexec.OBSExec(cfg, run=False)
+            obs.run()
+            with self._lock:
+                self._n_started += 1
+                index = self._n_started
+            self._baselines[obs] = _Baseline(obs, self.config_name, index)
+            self._idle.put(obs)
+        except BaseException as e:
+            # Do not leak the process and the private root of the instance.
+            if obs and obs.proc_obs and obs.proc_obs.poll() is None:
+                obs.proc_obs.kill()
+                obs.proc_obs.wait()
+            if cfg:
+                cfg.cleanup()
+            # Wake up `checkout` instead of letting it wait forever.
+            self._idle.put(e)
+            raise
+
+    def checkout(self, timeout=None):
+        '''Take an instance from the pool
+        :param timeout:  Seconds to wait for an instance. None to wait forever.
+        :return:         OBSExec instance.
+        '''
+        try:
+            obs = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            # pylint: disable=raise-missing-from
+            raise TimeoutError('No OBS instance is available in the pool')
+        if isinstance(obs, BaseException):
+            raise RuntimeError('Failed to start OBS instance for the pool') from obs
+        return obs
+
+    def checkin(self, obs, log_prefix=None):
+        '''Return an instance to the pool
+        The instance is reset in background, or restarted if the reset fails.
+        :param obs:         OBSExec instance taken by `checkout`.
+        :param log_prefix:  Prefix of the log file name if the instance is shut down,
+                            such as the name of the test. Default is the index of the instance.
+        :return:            Future of the list of the problems found, such as the errors reported
+                            by the instance and the memory leaks if it was shut down. The future
+                            is done once the instance is reset or shut down, before it is
+                            restarted.
+        '''
+        result = Future()
+        self._executor.submit(self._recycle, obs, result, log_prefix)
+        return result
+
+    def _reset(self, obs, problems):
+        if obs.proc_obs.poll() is not None:
+            problems.append(f'OBS exit with code {obs.proc_obs.returncode}')
+            return False
+        errors = obs.get_errors()
+        if errors:
+            problems += errors
+            return False
+        cl = obs.get_obsws()
+        # Let the requests sent by `OBSUI.submit` finish before the reset.
+        obsui.OBSUI(cl).flush()
+        baseline = self._baselines[obs]
+        _restore_profile(cl, baseline)
+        _restore_scene_collection(cl, baseline)
+        return True
+
+    def _recycle(self, obs, result, log_prefix):
+        # Any exception has to end in returning, or retiring and restarting the instance.
+        # Otherwise the process leaks and `checkout` waits forever.
+        # pylint: disable=broad-exception-caught
+        problems = []
+        try:
+            healthy = self._reset(obs, problems)
+        except Exception as e:
+            sys.stderr.write(f'Info: Failed to reset OBS instance: {e!r}\n')
+            healthy = False
+        if healthy:
+            self._idle.put(obs)
+            result.set_result(problems)
+            return
+        with self._lock:
+            self.restarts += 1
+        try:
+            self._retire(obs, problems, log_prefix)
+        except Exception as e:
+            problems.append(f'Failed to retire OBS instance: {e!r}')
+        finally:
+            result.set_result(problems)
+        self._start_instance()
+
+    def _retire(self, obs, problems, log_prefix=None):
+        index = self._baselines.pop(obs).index
+        try:
+            if obs.proc_obs.poll() is None:
+                obs.shutdown()
+            else:
+                obs.wait(check_error=False)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            problems.append(str(e))
+
+        try:
+            leaks = obs.get_memory_leaks()
+            if leaks != 0:
+                problems.append(f'Number of memory leaks: {leaks}')
+            self._move_log(obs, log_prefix or f'pool{index}-')
+        finally:
+            if obs.proc_obs.poll() is None:
+                obs.proc_obs.kill()
+                obs.proc_obs.wait()
+            obs.config.cleanup()
+
+    @staticmethod
+    def _move_log(obs, prefix):
+        try:
+            src = obs.get_logfile()
+        except FileNotFoundError:
+            src = None
+        if src:
+            src_timing = obs.get_timing_file()
+            logsdir = util.get_logs_dir()
+            os.makedirs(logsdir, exist_ok=True)
+            name = os.path.basename(src).replace('-', '').replace(' ', '-')
+            dst = f'{logsdir}/{prefix}{name}'
+            shutil.move(src, dst)
+            if os.path.exists(src_timing):
+                shutil.move(src_timing, os.path.splitext(dst)[0] + '.timing.json')
+
+    def close(self, check=True):
+        '''Shutdown all instances
+        :param check:  Raise OSError if any instance had a problem.
+        '''
+        self._executor.shutdown(wait=True)
+        while not self._idle.empty():
+            obs = self._idle.get()
+            if not isinstance(obs, BaseException):
+                self._retire(obs, self.problems)
+        if self.problems and check:
+            raise OSError('OBS pool has problems:\n' + '\n'.join(self.problems))
@@ -6,40 +6,59 @@ import os
 import os.path
 import shutil
 import unittest
-from onsdriver import obsconfig, obsexec
+from onsdriver import obsconfig, obsexec, util
 
 class OBSTest(unittest.TestCase):
     'Base class to test with OBS Studio'
+
+    # Set true to run each test with a private configuration directory and websocket port
+    # so that test cases can run in parallel on one host. `ONSDRIVER_ISOLATED` also sets it.
+    isolated = False
+
+    # Set an instance of `onsdriver.obspool.OBSPool` to reuse running OBS Studio.
+    pool = None
+
+    # Class to provision the configuration from the saved one.
+    # Set `obsconfig.OBSConfigLinkFromSaved` to synchronize only changed files for each test.
+    config_class = obsconfig.OBSConfigCopyFromSaved
+
     def setUp(self, config_name='saved-config', run=True):
-        cfg = obsconfig.OBSConfigCopyFromSaved(config_name)
-        self.obs = obsexec.OBSExec(cfg, run=run)
         self.name = self.id() # .rsplit('.', 1)[-1]
+        if self.pool:
+            self.obs = self.pool.checkout()
+            return
+        isolated = self.isolated or obsconfig.isolated_by_default()
+        cfg = self.config_class(config_name, isolated=isolated)
+        # Remove the private root even if the test or `tearDown` fails.
+        self.addCleanup(cfg.cleanup)
+        self.obs = obsexec.OBSExec(cfg, run=run)
 
     def tearDown(self):
+        if self.pool:
+            # Memory leaks are known only if the instance is shut down for a problem.
+            problems = self.pool.checkin(self.obs, log_prefix=self.name+'-').result()
+            self.assertEqual(problems, [])
+            return
         self.obs.shutdown()
         self.assertEqual(self.memory_leak(), 0)
         self.move_log(prefix=self.name+'-')
 
     def memory_leak(self):
         'Return the number of memory leak in the last log, or -1 if not found.'
-        with open(self.obs.get_logfile(), encoding='utf-8') as fr:
-            for l in fr:
-                if 'Number of memory leaks:' in l:
-                    return int(l.rsplit(' ', 1)[-1])
-        return -1
+        return self.obs.get_memory_leaks()
 
     def move_log(self, prefix=''):
         '''Move the last log
         :param prefix:  The prefix of the destination file name.'
         '''
         src = self.obs.get_logfile()
+        src_timing = self.obs.get_timing_file()
         dst = prefix + os.path.basename(src).replace('-', '').replace(' ', '-')
         if not os.path.isabs(prefix):
-            try:
-                logsdir = os.environ['ONSDRIVER_LOGS']
-            except KeyError:
-                logsdir = 'logs'
+            logsdir = util.get_logs_dir()
             os.makedirs(logsdir, exist_ok=True)
             dst = logsdir + '/' + dst
 
         shutil.move(src, dst)
+        if src_timing and os.path.exists(src_timing):
+            shutil.move(src_timing, os.path.splitext(dst)[0] + '.timing.json')
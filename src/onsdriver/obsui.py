@@ -3,12 +3,31 @@ Communicate with ui-ws-automation plugin
 '''
 
 import base64
+import json
 import os
 import os.path
-from time import sleep
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import obsws_python
+from onsdriver import util, xvfb_run
+from onsdriver import _obswsproto as proto
+from onsdriver._widgettree import WidgetTree
 
 _VENDOR_NAME = 'ui-ws-automation'
 
+_ERROR_NO_OBJECT = 'Error: no object found'
+
+# Seconds to keep retrying for each count of `retry` while the object is not found.
+_RETRY_WAIT = 1.0
+
+# The longest interval to poll ui-ws-automation while waiting for an object.
+_POLL_CAP = 0.2
+
+# Requests that do not change the widgets, other requests discard the cached trees.
+_READONLY_REQUESTS = ('widget-list', 'menu-list', 'widget-grab')
+
 def _obj_match(obj, cond):
     for key, value in cond.items():
         if key not in obj:
@@ -28,75 +47,389 @@ def _find_object(objs, children_key, path, i_path=0):
             return ret
     return None
 
+def _vendor_data(d):
+    '''Return the response of ui-ws-automation from a response of CallVendorRequest
+    :return:  The response data, or None if the object is not found.
+    '''
+    data = proto.response_data(d).get('responseData', {})
+    if 'error' in data:
+        if data['error'] == _ERROR_NO_OBJECT:
+            return None
+        raise OSError(data['error'])
+    return data
+
+class _Connection:
+    '''Websocket for pipelined requests of OBSUI
+
+    The websocket is opened separately from the one of obsws_python.ReqClient, with the same
+    parameters, since `ReqClient.send` reads the next message as its response without
+    checking the request ID. It is closed when the ReqClient is deleted.
+    Requests are sent without waiting for the previous responses.
+    The thread waiting for a response reads the websocket and keeps the other responses.
+    '''
+    def __init__(self, cl):
+        bc = cl.base_client
+        client = obsws_python.baseclient.ObsClient(
+                host=bc.host, port=bc.port, password=bc.password, timeout=bc.timeout, subs=0)
+        client.authenticate()
+        self._ws = client.ws
+        weakref.finalize(cl, self._ws.close)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._responses = {}
+        # Cached WidgetTree and the time it was requested for each request type.
+        self.trees = {}
+        self.generation = 0
+
+    def invalidate(self):
+        'Discard the cached trees'
+        self.generation += 1
+        self.trees.clear()
+
+    def send(self, request_id, msg):
+        'Send a message without waiting for the response'
+        with self._lock:
+            self._ws.send(json.dumps(msg))
+            self._pending.add(request_id)
+
+    def _read_one(self):
+        msg = json.loads(self._ws.recv())
+        if msg['op'] not in (proto.OP_REQUEST_RESPONSE, proto.OP_REQUEST_BATCH_RESPONSE):
+            return
+        request_id = msg['d']['requestId']
+        if request_id in self._pending:
+            self._pending.remove(request_id)
+            self._responses[request_id] = msg['d']
+
+    def receive(self, request_id):
+        '''Wait for the response of a request sent by `send`
+        :return:  The 'd' field of the response.
+        '''
+        with self._lock:
+            while request_id not in self._responses:
+                self._read_one()
+            return self._responses.pop(request_id)
+
+    def flush(self):
+        'Read all the responses not received yet'
+        with self._lock:
+            while self._pending:
+                self._read_one()
+
+_connections = weakref.WeakKeyDictionary()
+_connections_lock = threading.Lock()
+
+def _get_connection(cl):
+    with _connections_lock:
+        conn = _connections.get(cl)
+        if not conn:
+            conn = _Connection(cl)
+            _connections[cl] = conn
+        return conn
+
+class RequestFuture:
+    'Response of a request to ui-ws-automation that has been sent'
+
+    def __init__(self, ui, request_id, param, retry):
+        self._ui = ui
+        self._request_id = request_id
+        self._param = param
+        self._retry = retry
+        self._done = False
+        self._result = None
+        self._error = None
+
+    def result(self):
+        '''Wait for the response
+        If the object is not found, the request is sent again until `retry` expires.
+        :return:  Dictionary of the response.
+        '''
+        # pylint: disable=protected-access
+        if not self._done:
+            d = self._ui._conn.receive(self._request_id)
+            self._done = True
+            try:
+                res = _vendor_data(d)
+                if res is None:
+                    res = self._ui._request(self._param, self._retry)
+                self._result = res
+            except (OSError, obsws_python.error.OBSSDKError) as e:
+                self._error = e
+        if self._error:
+            raise self._error
+        return self._result
+
+    def discard(self):
+        'Receive the response if not yet, without checking it'
+        if not self._done:
+            self._ui._conn.receive(self._request_id) # pylint: disable=protected-access
+            self._done = True
+
+class GrabResult:
+    # pylint: disable=too-few-public-methods
+    'Result of each widget of `OBSUI.grab_many`'
+    def __init__(self, path, filename):
+        self.path = path
+        self.filename = filename
+        self.png = None
+        self.request_time = 0.0
+        self.decode_time = 0.0
+        self.write_time = 0.0
+
+    def __str__(self):
+        return (f'request {self.request_time * 1e3:.1f} ms, '
+                f'decode {self.decode_time * 1e3:.1f} ms, write {self.write_time * 1e3:.1f} ms')
+
+def _decode_grab(res, result):
+    t = time.monotonic()
+    png = base64.b64decode(res['image'])
+    result.decode_time = time.monotonic() - t
+    if result.filename:
+        t = time.monotonic()
+        _save_png(png, result.filename)
+        result.write_time = time.monotonic() - t
+    else:
+        result.png = png
+    return result
+
+def _save_png(png, filename):
+    if not filename:
+        return png
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wb') as fw:
+        fw.write(png)
+    return None
+
 class OBSUI:
     'Communicate with ui-ws-automation plugin'
 
-    def __init__(self, cl):
+    def __init__(self, cl, cache_ttl=0.5):
+        '''
+        :param cl:         Instance of obsws_python.ReqClient.
+                           Instances of OBSUI created with the same client share a connection,
+                           which is separate from `cl`, and the cached widget and menu trees.
+        :param cache_ttl:  Seconds to reuse the widget and menu trees if `use_cache` is set.
+                           Set 0 to disable the cache. The cache is also discarded when a request
+                           that may change the widgets is sent.
+        '''
         self.cl = cl
+        self.cache_ttl = cache_ttl
+        self._conn = _get_connection(cl)
+
+    def _send(self, param):
+        if param['requestType'] not in _READONLY_REQUESTS:
+            self._conn.invalidate()
+        request_id, msg = proto.request('CallVendorRequest', param)
+        self._conn.send(request_id, msg)
+        return request_id
 
     def _request(self, param, retry):
-        res = self.cl.send('CallVendorRequest', param)
-        if 'error' in res.response_data:
-            error = res.response_data['error']
-            if error == 'Error: no object found' and retry > 0:
-                sleep(1)
-                return self._request(param, retry - 1)
-            raise OSError(error)
-        return res.response_data
+        def _attempt():
+            res = _vendor_data(self._conn.receive(self._send(param)))
+            if res is None:
+                return None
+            # Wrap the response since an empty response is also a success.
+            return (res, )
 
-    def request(self, request_type, request_data, retry=3):
-        'Invoke a request on ui-ws-automation'
-        param = {
+        try:
+            return util.wait_until(_attempt, timeout=retry * _RETRY_WAIT,
+                                   backoff=util.Backoff(initial=0.02, cap=_POLL_CAP))[0]
+        except TimeoutError:
+            raise OSError(_ERROR_NO_OBJECT) from None
+
+    @staticmethod
+    def _param(request_type, request_data):
+        return {
                 'vendorName': _VENDOR_NAME,
                 'requestType': request_type,
                 'requestData': request_data,
         }
-        return self._request(param, retry)
 
-    def menu_list(self, path=None):
-        'Return a list of menu actions'
-        res = self.request('menu-list', {})
-        if not path:
-            return res
-        return _find_object(res, 'menu', path)
+    def request(self, request_type, request_data, retry=3):
+        'Invoke a request on ui-ws-automation'
+        return self._request(self._param(request_type, request_data), retry)
+
+    def submit(self, request_type, request_data, retry=3):
+        '''Send a request on ui-ws-automation without waiting for the response
+        Call `result` of the returned object to get the response.
+        Requests are processed by OBS Studio in the order they are sent.
+        :return:  RequestFuture instance.
+        '''
+        param = self._param(request_type, request_data)
+        return RequestFuture(self, self._send(param), param, retry)
+
+    def batch(self, requests, retry=3):
+        '''Invoke independent requests on ui-ws-automation in one round trip
+        The requests are executed in the order, but a request whose object is not found does not
+        stop the following requests. It is sent again alone until `retry` expires, after the
+        following requests have been executed. Use `request` for steps that depend on the
+        previous ones, such as clicking through a dialog.
+        :param requests:  List of tuples of the request type and the request data.
+        :return:          List of the responses.
+        '''
+        params = [self._param(t, d) for t, d in requests]
+        if any(p['requestType'] not in _READONLY_REQUESTS for p in params):
+            self._conn.invalidate()
+        request_id, msg = proto.request_batch([('CallVendorRequest', p) for p in params])
+        self._conn.send(request_id, msg)
+        results = self._conn.receive(request_id)['results']
+        ret = []
+        for param, d in zip(params, results):
+            res = _vendor_data(d)
+            if res is None:
+                res = self._request(param, retry)
+            ret.append(res)
+        return ret
+
+    def flush(self):
+        'Wait for all the responses of `submit`'
+        self._conn.flush()
+
+    def invalidate_cache(self):
+        'Discard the cached widget and menu trees'
+        self._conn.invalidate()
+
+    def invalidate_cache_on(self, events):
+        '''Discard the cached widget and menu trees whenever an event arrives
+        :param events:  Instance of onsdriver.obsevent.OBSEvents.
+        :return:        The handler added to `events`.
+        '''
+        def _handler(_event_type, _data):
+            self._conn.invalidate()
+        events.add_handler(_handler)
+        return _handler
+
+    def _get_tree(self, request_type, children_key, use_cache):
+        conn = self._conn
+        now = time.monotonic()
+        if use_cache and request_type in conn.trees:
+            t, tree = conn.trees[request_type]
+            if now - t < self.cache_ttl:
+                return tree
+        generation = conn.generation
+        tree = WidgetTree(self.request(request_type, {}), children_key)
+        if self.cache_ttl > 0 and generation == conn.generation:
+            conn.trees[request_type] = (now, tree)
+        return tree
 
-    def widget_list(self, path=None):
-        'Return a list of widgets'
-        res = self.request('widget-list', {})
+    def _list(self, request_type, children_key, path, use_cache):
+        tree = self._get_tree(request_type, children_key, use_cache)
         if not path:
-            return res
-        return _find_object(res, 'children', path)
+            return tree.root
+        try:
+            return tree.find(path)
+        except TypeError:
+            return _find_object(tree.root, children_key, path)
 
-    def _grab_by_pillow(self, path, filename):
+    def menu_list(self, path=None, use_cache=False):
+        '''Return a list of menu actions
+        :param path:       Optional list to describe the menu action to return.
+        :param use_cache:  Reuse the menu tree requested within `cache_ttl`. The tree does not
+                           reflect changes made otherwise than by requests of this connection,
+                           such as by timers or by other clients.
+        '''
+        return self._list('menu-list', 'menu', path, use_cache)
+
+    def widget_list(self, path=None, use_cache=False):
+        '''Return a list of widgets
+        :param path:       Optional list to describe the widget to return.
+        :param use_cache:  Reuse the widget tree requested within `cache_ttl`. The tree does not
+                           reflect changes made otherwise than by requests of this connection,
+                           such as by timers or by other clients.
+        '''
+        return self._list('widget-list', 'children', path, use_cache)
+
+    def grab_many(self, paths, window=False, filenames=None, max_workers=4):
+        '''Grab images of widgets
+        All the requests are sent at once, and the images are decoded and saved by worker threads
+        while the following responses are received.
+        :param paths:        List of the paths of the widgets.
+        :param window:       Boolean value to control grab type.
+        :param filenames:    Optional list of the file names to save the PNG files to.
+        :param max_workers:  Number of the threads to decode and save the images.
+        :return:             List of GrabResult instances in the order of `paths`.
+                             `png` is set if the file name is not given.
+        '''
+        s_type = 'window' if window else 'grab'
+        futures = [(time.monotonic(), self.submit('widget-grab', {'path': path, 'type': s_type}))
+                   for path in paths]
+        jobs = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                for i, (t, future) in enumerate(futures):
+                    res = future.result()
+                    result = GrabResult(paths[i], filenames[i] if filenames else None)
+                    result.request_time = time.monotonic() - t
+                    jobs.append(executor.submit(_decode_grab, res, result))
+            finally:
+                for _, future in futures:
+                    future.discard()
+            return [job.result() for job in jobs]
+
+    def wait_for_widget(self, path, timeout=5.0, stats=None):
+        '''Wait until a widget exists
+        The widget list is polled with backoff intervals, starting from 20 ms.
+        :param path:     List to describe the widget.
+        :param timeout:  Timeout in second.
+        :param stats:    Optional util.WaitStats instance to record the attempts.
+        :return:         Tuple of the widget and the seconds waited.
+        :raises TimeoutError:  The widget did not appear within the timeout.
+        '''
+        if stats is None:
+            stats = util.WaitStats()
+        widget = util.wait_until(lambda: self.widget_list(path, use_cache=False),
+                                 timeout=timeout, stats=stats,
+                                 backoff=util.Backoff(initial=0.02, cap=_POLL_CAP),
+                                 error_msg=f'Waiting widget {path}')
+        return widget, stats.elapsed
+
+    def geometry(self, path):
+        '''Return the geometry of a widget in the screen coordinate
+        :param path:  List to describe the widget.
+        :return:      Tuple of x, y, width and height.
+        '''
         geo = self.request('widget-invoke', {
             'path': path,
             'method': 'frameGeometry',
             'mapToGlobal': True,
         })
-        x, y = geo['x'], geo['y']
-        w, h = geo['width'], geo['height']
+        return geo['x'], geo['y'], geo['width'], geo['height']
+
+    def _grab_by_pillow(self, path, filename):
+        x, y, w, h = self.geometry(path)
         from PIL import ImageGrab # pylint: disable=import-outside-toplevel
         img = ImageGrab.grab(bbox=(x, y, x+w, y+h))
         if filename:
             return img.save(filename)
         return img
 
-    def grab(self, path, window=False, pillow=False, filename=None):
+    def _grab_by_framebuffer(self, path, filename):
+        fb = xvfb_run.get_framebuffer()
+        if not fb:
+            raise RuntimeError('Framebuffer of Xvfb is not enabled')
+        x, y, w, h = self.geometry(path)
+        arr = fb.rgb(x, y, w, h)
+        if filename:
+            from PIL import Image # pylint: disable=import-outside-toplevel
+            return Image.fromarray(arr).save(filename)
+        return arr
+
+    def grab(self, path, window=False, pillow=False, filename=None, framebuffer=False):
         '''Request to get an image of a widget
-        :param path:      List to describe the widget.
-        :param window:    Boolean value to control grab type.
-        :param pillow:    Use Pillow to grab if true.
-        :param filename:  File name to save the PNG file to. If given, None is returned.
-        :return:          Bytes object representing PNG.
+        :param path:         List to describe the widget.
+        :param window:       Boolean value to control grab type.
+        :param pillow:       Use Pillow to grab if true.
+        :param filename:     File name to save the PNG file to. If given, None is returned.
+        :param framebuffer:  Read the screen of Xvfb if true, see `xvfb_run.xvfb_run`.
+                             A numpy array of RGB viewing the screen is returned,
+                             call `copy()` of it to keep the image.
+        :return:             Bytes object representing PNG.
         '''
+        if framebuffer:
+            return self._grab_by_framebuffer(path=path, filename=filename)
         if pillow:
             return self._grab_by_pillow(path=path, filename=filename)
         s_type = 'window' if window else 'grab'
         res = self.request('widget-grab', {'path': path, 'type': s_type})
-        png = base64.b64decode(res['image'])
-        if filename:
-            os.makedirs(os.path.dirname(filename), exist_ok=True)
-            with open(filename, 'wb') as fw:
-                fw.write(png)
-            return None
-        return png
+        return _save_png(base64.b64decode(res['image']), filename)
@@ -0,0 +1,181 @@
+'''
+Record a widget continuously into a ring buffer
+
+This module requires numpy, and Pillow unless the framebuffer of Xvfb is used.
+'''
+
+import io
+import os
+import os.path
+import sys
+import threading
+import time
+from onsdriver import util, xvfb_run
+
+def _decode_png(png):
+    import numpy # pylint: disable=import-outside-toplevel,import-error
+    from PIL import Image # pylint: disable=import-outside-toplevel
+    with Image.open(io.BytesIO(png)) as img:
+        return numpy.asarray(img.convert('RGB'))
+
+class FrameRecorder:
+    '''Capture a widget at a target frame rate on a background thread
+
+    Frames are stored into a preallocated ring buffer, so that only the last `capacity` frames
+    are kept. If the framebuffer of Xvfb is enabled, the region of the widget is copied from it,
+    otherwise the widget is grabbed by ui-ws-automation.
+
+    Used as a context manager, the recording stops at the end of the block,
+    and the frames are saved to the logs directory if an exception is raised.
+    '''
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, ui, path, fps=30, capacity=120, *, window=False, framebuffer=None,
+                 dump_name='frames'):
+        # pylint: disable=too-many-arguments
+        '''
+        :param ui:           Instance of onsdriver.obsui.OBSUI.
+        :param path:         List to describe the widget.
+        :param fps:          Target frame rate.
+        :param capacity:     Number of the frames to keep.
+        :param window:       Grab the window of the widget instead of the widget.
+        :param framebuffer:  XWDFramebuffer to read. Default is the one of `xvfb_run.xvfb_run`.
+        :param dump_name:    Base name of the file saved on an exception.
+        '''
+        self.ui = ui
+        self.path = path
+        self.fps = fps
+        self.capacity = capacity
+        self.window = window
+        self.dump_name = dump_name
+        self.n_frames = 0
+        self.n_dropped = 0
+        self._fb = framebuffer or xvfb_run.get_framebuffer()
+        self._region = None
+        self._buffer = None
+        self._timestamps = None
+        self._resized_shape = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._error = None
+        self._start_time = None
+        self._end_time = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop(check=exc_type is None)
+        if exc_type is not None and self.n_frames:
+            self.dump()
+
+    def _capture(self):
+        if self._fb:
+            return self._fb.rgb(*self._region)
+        return _decode_png(self.ui.grab(self.path, window=self.window))
+
+    def _store(self, frame, timestamp):
+        import numpy # pylint: disable=import-outside-toplevel,import-error
+        with self._lock:
+            if self._buffer is None:
+                self._buffer = numpy.empty((self.capacity, ) + frame.shape, dtype=numpy.uint8)
+                self._timestamps = numpy.zeros(self.capacity)
+            elif self._buffer.shape[1:] != frame.shape:
+                # The widget is resized. Such a frame cannot be stored.
+                self.n_dropped += 1
+                if frame.shape != self._resized_shape:
+                    self._resized_shape = frame.shape
+                    sys.stderr.write(f'Warning: {self.path}: Frame size changed from '
+                                     f'{self._buffer.shape[2]}x{self._buffer.shape[1]} to '
+                                     f'{frame.shape[1]}x{frame.shape[0]}, dropping the frames\n')
+                return
+            slot = self.n_frames % self.capacity
+            numpy.copyto(self._buffer[slot], frame)
+            self._timestamps[slot] = timestamp
+            self.n_frames += 1
+
+    def _run(self):
+        interval = 1.0 / self.fps
+        next_time = self._start_time
+        try:
+            while not self._stop.is_set():
+                t = time.monotonic()
+                self._store(self._capture(), t - self._start_time)
+                next_time += interval
+                now = time.monotonic()
+                if now > next_time:
+                    # Count the slots passed while capturing as dropped frames.
+                    missed = int((now - next_time) / interval)
+                    with self._lock:
+                        self.n_dropped += missed
+                    next_time += missed * interval
+                self._stop.wait(max(next_time - now, 0))
+        except Exception as e: # pylint: disable=broad-exception-caught
+            self._error = e
+        finally:
+            self._end_time = time.monotonic()
+
+    def start(self):
+        'Start recording'
+        if self._fb:
+            self._region = self.ui.geometry(self.path)
+        self._stop.clear()
+        self._error = None
+        self._start_time = time.monotonic()
+        self._end_time = None
+        self._thread = threading.Thread(target=self._run, name='onsdriver-recorder', daemon=True)
+        self._thread.start()
+
+    def stop(self, check=True):
+        '''Stop recording
+        :param check:  Raise the exception that stopped the recording.
+        '''
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if check and self._error:
+            raise self._error
+
+    @property
+    def achieved_fps(self):
+        'Frame rate actually recorded'
+        if self._start_time is None:
+            return 0.0
+        elapsed = (self._end_time or time.monotonic()) - self._start_time
+        return self.n_frames / elapsed if elapsed > 0 else 0.0
+
+    def frames(self, n=None):
+        '''Return the recorded frames, oldest first
+        :param n:  Number of the last frames to return. Default is all the frames kept.
+        :return:   Tuple of numpy arrays of the timestamps in second from the start
+                   and the frames of the shape (n, height, width, 3).
+        '''
+        import numpy # pylint: disable=import-outside-toplevel,import-error
+        with self._lock:
+            kept = min(self.n_frames, self.capacity)
+            n = kept if n is None else min(n, kept)
+            if not n:
+                return numpy.zeros(0), numpy.zeros((0, 0, 0, 3), dtype=numpy.uint8)
+            slots = numpy.arange(self.n_frames - n, self.n_frames) % self.capacity
+            return self._timestamps[slots], self._buffer[slots]
+
+    def dump(self, filename=None, n=None):
+        '''Save the recorded frames into a numpy .npz file
+        :param filename:  File name. Default is in the logs directory named by `dump_name`.
+        :param n:         Number of the last frames to save.
+        :return:          The file name.
+        '''
+        import numpy # pylint: disable=import-outside-toplevel,import-error
+        if not filename:
+            logsdir = util.get_logs_dir()
+            filename = f'{logsdir}/{self.dump_name}-{time.strftime("%Y%m%d-%H%M%S")}.npz'
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        timestamps, frames = self.frames(n)
+        numpy.savez_compressed(filename, timestamps=timestamps, frames=frames)
+        return filename
+
+    def __str__(self):
+        return (f'{self.n_frames} frames at {self.achieved_fps:.1f} fps, '
+                f'{self.n_dropped} dropped')
@@ -2,7 +2,11 @@
 This module provides useful functions when testing with obs-studio.
 '''
 
+import os
 import os.path
+import random
+import selectors
+import sys
 import time
 
 class RetryAttempt:
@@ -37,17 +41,151 @@ def retry(timeout, each_wait=0.1, error_msg=None):
     :param timeout:    Set the timeout in second
     :param each_wait:  Sleep time for each
     '''
+    deadline = time.monotonic() + timeout
     attempt = RetryAttempt(1, error_msg)
     yield attempt
 
-    count = int(timeout // each_wait + 0.5)
-    while count > 0:
-        time.sleep(each_wait)
+    while time.monotonic() < deadline:
+        time.sleep(min(each_wait, max(deadline - time.monotonic(), 0)))
         yield attempt.increment()
-        count -= 1
 
     raise TimeoutError(attempt.error_msg)
 
+class Backoff:
+    '''Intervals growing exponentially up to a cap
+    Each interval is randomized by the jitter ratio so that multiple waiters do not synchronize.
+    '''
+    # pylint: disable=too-few-public-methods
+    def __init__(self, initial=0.01, factor=2.0, cap=1.0, jitter=0.1):
+        '''
+        :param initial:  The first interval in second.
+        :param factor:   Multiplier applied to the interval after each attempt.
+        :param cap:      The maximum interval in second.
+        :param jitter:   Ratio to randomize each interval.
+        '''
+        self.initial = initial
+        self.factor = factor
+        self.cap = cap
+        self.jitter = jitter
+
+    def __iter__(self):
+        interval = self.initial
+        while True:
+            if self.jitter:
+                yield interval * random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+            else:
+                yield interval
+            interval = min(interval * self.factor, self.cap)
+
+class WaitStats:
+    'Statistics of the attempts in `wait_until`'
+    def __init__(self):
+        self.start = time.monotonic()
+        self.elapsed = 0.0
+        self.latencies = []
+
+    @property
+    def attempts(self):
+        'Number of the attempts'
+        return len(self.latencies)
+
+    @property
+    def max_latency(self):
+        'The longest time spent in an attempt'
+        return max(self.latencies, default=0.0)
+
+    @property
+    def mean_latency(self):
+        'The average time spent in an attempt'
+        if not self.latencies:
+            return 0.0
+        return sum(self.latencies) / len(self.latencies)
+
+    def record(self, latency):
+        'Record an attempt'
+        self.latencies.append(latency)
+        self.elapsed = time.monotonic() - self.start
+
+    def __str__(self):
+        attempts = 'attempt' if self.attempts <= 1 else 'attempts'
+        return f'{self.attempts} {attempts} in {self.elapsed:.3f} s'
+
+def _open_pidfd(proc):
+    if sys.platform != 'linux' or not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(proc.pid)
+    except OSError:
+        return None
+
+class _Waker:
+    'Sleep until a file descriptor is readable or a process exits'
+    def __init__(self, fds, procs):
+        self._sel = selectors.DefaultSelector()
+        self._pidfds = []
+        if sys.platform == 'win32':
+            # selectors supports only sockets on Windows.
+            return
+        for fd in fds:
+            self._sel.register(fd, selectors.EVENT_READ)
+        for proc in procs:
+            pidfd = _open_pidfd(proc)
+            if pidfd is not None:
+                self._pidfds.append(pidfd)
+                self._sel.register(pidfd, selectors.EVENT_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._sel.close()
+        for pidfd in self._pidfds:
+            os.close(pidfd)
+
+    def sleep(self, interval):
+        'Sleep up to the interval'
+        if self._sel.get_map():
+            self._sel.select(interval)
+        else:
+            time.sleep(interval)
+
+def wait_until(
+        # pylint: disable=too-many-arguments
+        cond, timeout, *, backoff=None, fds=(), procs=(), error_msg=None, stats=None):
+    '''Wait until a condition is met, by a monotonic deadline
+    Between the attempts, sleep by the backoff intervals, but wake up as soon as any of
+    the file descriptors is readable or any of the processes exits.
+    :param cond:       Callable without arguments. A true value ends the wait.
+                       It should consume the readiness of `fds`.
+    :param timeout:    Timeout in second.
+    :param backoff:    Backoff instance for the intervals. Default is `Backoff()`.
+    :param fds:        File objects or descriptors to wake up on readiness.
+                       Ignored on Windows.
+    :param procs:      Popen instances. ChildProcessError is raised if any of them exits.
+    :param error_msg:  Message for TimeoutError.
+    :param stats:      Optional WaitStats instance to record the attempts.
+    :return:           The value returned by `cond`.
+    '''
+    deadline = time.monotonic() + timeout
+    if stats is None:
+        stats = WaitStats()
+    intervals = iter(backoff or Backoff())
+
+    with _Waker(fds, procs) as waker:
+        while True:
+            exited = [proc for proc in procs if proc.poll() is not None]
+            t = time.monotonic()
+            ret = cond()
+            stats.record(time.monotonic() - t)
+            if ret:
+                return ret
+            if exited:
+                raise ChildProcessError(f'Process exit with code {exited[0].returncode}')
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f'{error_msg or "Waiting condition"} ({stats})')
+            waker.sleep(min(next(intervals), remaining))
+
 def ignore_directory(path):
     '''Create .gitignore file to ignore the directory
     :param path:  Path of the directory to be ignored
@@ -57,3 +195,7 @@ def ignore_directory(path):
         return
     with open(ignore_path, 'w', encoding='ascii') as fw:
         fw.write('*\n')
+
+def get_logs_dir():
+    'Return the directory to move log files to'
+    return os.environ.get('ONSDRIVER_LOGS', 'logs')
@@ -3,26 +3,17 @@ Run Xvfb
 '''
 
 import tempfile
-import time
 import os
 import os.path
 import subprocess
 import sys
+import threading
+from onsdriver._xwd import XWDFramebuffer
 
 _SCREEN_RES = '1080x768x24'
 
 _INST = None
-
-def _find_free_servernum(num):
-    def _exists(i):
-        if os.path.exists(f'/tmp/.X{i}-lock'):
-            return True
-        if os.path.exists(f'/tmp/.X11-unix/X{i}'):
-            return True
-        return False
-    while _exists(num):
-        num -= 1
-    return num
+_INST_LOCK = threading.Lock()
 
 def _mcookie():
     res = subprocess.run(['mcookie', ], check=True, capture_output=True)
@@ -36,9 +27,16 @@ def _xauth_add(num, proto='.', mcookie=None):
 class XvfbRun:
     'Class to run xvfb'
 
-    def __init__(self, start=True):
+    def __init__(self, start=True, framebuffer=False):
+        '''
+        :param start:        Start Xvfb.
+        :param framebuffer:  Let Xvfb keep the screen in a file so that `framebuffer` can read it.
+        '''
         self.d = None
         self.proc_xvfb = None
+        self.fbdir = None
+        self.framebuffer_enabled = framebuffer
+        self._fb = None
         if start:
             self.start()
 
@@ -46,25 +44,55 @@ class XvfbRun:
         self.cleanup()
 
     def start(self):
-        'Start Xvfb'
-        num = _find_free_servernum(99)
+        '''Start Xvfb
+        Xvfb selects a free display number by itself and reports it when it is ready to accept
+        connections, so that multiple processes can start Xvfb at the same time.
+        '''
         self.d = tempfile.TemporaryDirectory(prefix='onsdriver-xvfb-') # pylint: disable=consider-using-with
         xauth = self.d.name + '/Xauthority'
         with open(xauth, 'w', encoding='ascii'):
             pass
         os.environ['XAUTHORITY'] = xauth
 
-        sys.stderr.write(f'Starting Xvfb on :{num}...\n')
-        self.proc_xvfb = subprocess.Popen( # pylint: disable=consider-using-with
-                ['Xvfb', f':{num}', '-screen', '0', _SCREEN_RES, '-nolisten', 'tcp', ],
-                stdout = subprocess.DEVNULL,
-                stderr = subprocess.DEVNULL,
-        )
-        time.sleep(1)
+        fd_r, fd_w = os.pipe()
+        cmd = ['Xvfb', '-displayfd', str(fd_w), '-screen', '0', _SCREEN_RES, '-nolisten', 'tcp', ]
+        if self.framebuffer_enabled:
+            self.fbdir = self.d.name + '/fb'
+            os.mkdir(self.fbdir)
+            cmd += ['-fbdir', self.fbdir]
+
+        sys.stderr.write('Starting Xvfb...\n')
+        try:
+            self.proc_xvfb = subprocess.Popen( # pylint: disable=consider-using-with
+                    cmd,
+                    stdout = subprocess.DEVNULL,
+                    stderr = subprocess.DEVNULL,
+                    pass_fds = (fd_w, ),
+            )
+        except OSError:
+            os.close(fd_r)
+            raise
+        finally:
+            os.close(fd_w)
+        with os.fdopen(fd_r, 'r', encoding='ascii') as fr:
+            line = fr.readline().strip()
+        if not line:
+            self.cleanup()
+            raise RuntimeError('Xvfb exited without reporting the display number')
+        num = int(line)
+        sys.stderr.write(f'Started Xvfb on :{num}\n')
 
         os.environ['DISPLAY'] = f':{num}'
         _xauth_add(num)
 
+    def framebuffer(self):
+        '''Return the screen memory-mapped from the file written by Xvfb
+        :return:  XWDFramebuffer instance, or None if the framebuffer is not enabled.
+        '''
+        if not self._fb and self.fbdir:
+            self._fb = XWDFramebuffer(self.fbdir + '/Xvfb_screen0')
+        return self._fb
+
     def detatch(self):
         '''Detatch the existing run
         The temporary directory won't be removed.
@@ -75,6 +103,9 @@ class XvfbRun:
 
     def cleanup(self):
         'Stop Xvfb'
+        if self._fb:
+            self._fb.close()
+            self._fb = None
         if self.proc_xvfb:
             self.proc_xvfb.terminate()
             try:
@@ -88,16 +119,29 @@ class XvfbRun:
             self.d.cleanup()
             self.d = None
 
-def xvfb_run():
-    'Start Xvfb instance'
+def xvfb_run(framebuffer=None):
+    '''Start Xvfb instance
+    :param framebuffer:  Enable the framebuffer file.
+                         Default is by the environment variable `ONSDRIVER_XVFB_FRAMEBUFFER`.
+    '''
+    if framebuffer is None:
+        framebuffer = bool(os.environ.get('ONSDRIVER_XVFB_FRAMEBUFFER'))
 
     # Xvfb process will be started only once for each script run.
     # The process will be terminated at the end of the script.
+    # The lock lets threads starting OBS concurrently share one Xvfb.
     global _INST # pylint: disable=global-statement
-    if not _INST:
-        _INST = XvfbRun()
+    with _INST_LOCK:
+        if not _INST:
+            _INST = XvfbRun(framebuffer=framebuffer)
     return _INST
 
+def get_framebuffer():
+    '''Return the screen of Xvfb started by `xvfb_run`
+    :return:  XWDFramebuffer instance, or None if not available.
+    '''
+    return _INST.framebuffer() if _INST else None
+
 def _get_args():
     import argparse # pylint: disable=import-outside-toplevel
     parser = argparse.ArgumentParser()